@@ -5,7 +5,16 @@ Summary:
 Import images (dcm,ima,mhd or hdr) into a copy of DICOM files from a specific SPECT-CT system
 
 Usage: DICOM_modify.py [-h] -m MODEL -w WORKSTATION -i INPUT_FOLDER
-                       [-o OUTPUT_FOLDER]                       
+                       [-o OUTPUT_FOLDER] [--mmap] [-j JOBS] [--incremental]
+                       [--pipeline DEPTH [--unordered]] [--compression {rle,deflated}]
+                       [--send AE_TITLE@HOST:PORT [--calling-ae AE_TITLE]] [--dry-run]
+                       [--profile PROFILE]
+       DICOM_modify.py [-h] -b BATCH [-m MODEL] [-w WORKSTATION]
+                       [--mmap] [-j JOBS] [--incremental]
+                       [--pipeline DEPTH [--unordered]] [--compression {rle,deflated}]
+                       [--send AE_TITLE@HOST:PORT [--calling-ae AE_TITLE]] [--dry-run]
+                       [--profile PROFILE]
+       or from Python: DICOM_modify.Converter(MODEL, WORKSTATION).case(INPUT_FOLDER)
 @author: jdabin
 
 Copyright (C) 2019 Jeremie Dabin                                       
@@ -27,17 +36,103 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #%%Library import
 from pathlib import Path
 import os
-import pydicom
-from pydicom._dicom_dict import DicomDictionary  # the actual dict of {tag: (VR, VM, name, is_retired, keyword), ...}
-import numpy as np
 import re
-import argparse
+import struct
+import functools
+import importlib
 import sys
-from natsort import natsorted
+import time
+import json
+import hashlib
+import tempfile
+import csv
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource=None
+
+class LazyModule:
+    """
+    
+    Summary:
+    module that is only imported when one of its attributes is first used
+    
+    Parameters:
+    - name: the module name
+   
+    Remarks:
+    - keeps "import DICOM_modify", --help and argument errors fast: numpy, pydicom and natsort are only
+      imported when images are processed
+    - safe to use from the threads of runJobs: the import is done once, under a lock
+    - attributes are kept once looked up, so later uses cost the same as with the module itself
+    - pydicom submodules (datadict, filebase, filewriter) are imported in the functions that use them
+      
+    """
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def __getattr__(self, attribute):
+        with self._lock:
+            if self._module is None:
+                self.__dict__["_module"] = importlib.import_module(self._name)
+        value = getattr(self._module, attribute)
+        self.__dict__[attribute] = value
+        return value
+
+np = LazyModule("numpy")
+pydicom = LazyModule("pydicom")
+natsort = LazyModule("natsort")
 
 list_models=["Brightview XCT", "Discovery 670", "Infinia Hawkeye4", "Optima 640", "Symbia T2", "Symbia Intevo Bold"]
 list_stations=["Hermes", "Jetstream", "Syngo","e.soft", "Xeleris"]
 
+# lossless compressed transfer syntaxes of the output files, see Compression
+output_syntaxes={"rle": "1.2.840.10008.1.2.5", "deflated": "1.2.840.10008.1.2.1.99"}
+# output syntaxes accepted by each workstation (the uncompressed syntax of the templates always is)
+workstation_syntaxes={"Hermes": ["rle", "deflated"], "Jetstream": [], "Syngo": ["rle", "deflated"], "e.soft": [],
+                      "Xeleris": ["rle"]}
+
+# tag rules applied to every SPECT file, in this order, see compileTagPlan
+# - tag: a tag, or a list of tags for nested tags (first item of each sequence)
+# - transform: "set" (value, created with VR if absent), "uid" (10000 added to the last element of the UID),
+#   "emission_count", "emission_frames", "emission_windows", "n_emission_windows" (only keep the emission
+#   window(s) and remove the scatter windows, see tag_transforms)
+# - models, workstations: the rule applies to these only (all if not given)
+# - unless: [tag, text] the rule does not apply to files whose tag contains text
+spect_tag_rules=[
+    #reference to series (0020,000E) and Media storage SOP instance UID (0002,0003) of Advanced NM
+    {"models": ["Symbia Intevo Bold"], "unless": [0x0008103E, "Advanced"], "tag": 0x00611077, "transform": "uid"},
+    {"models": ["Symbia Intevo Bold"], "unless": [0x0008103E, "Advanced"], "tag": 0x00611078, "transform": "uid"},
+    #remove or modify tags related to scatter windows
+    {"workstations": ["Hermes"], "tag": 0x00280008, "transform": "emission_count"},
+    {"workstations": ["Hermes"], "tag": 0x00540010, "transform": "emission_frames"},
+    {"workstations": ["Hermes"], "tag": 0x00540011, "transform": "n_emission_windows"},
+    {"workstations": ["Hermes"], "tag": 0x00540012, "transform": "emission_windows"},
+    {"workstations": ["Hermes"], "tag": 0x00540020, "transform": "emission_frames"},
+    {"workstations": ["Hermes"], "tag": 0x00540050, "transform": "emission_frames"},
+    {"workstations": ["Hermes"], "tag": 0x00540090, "transform": "emission_frames"},
+    #Siemens specific tags
+    {"models": ["Symbia T2", "Symbia Intevo Bold"], "workstations": ["Hermes"],
+     "tag": 0x00351001, "transform": "set", "value": "Simulated EM1", "VR": "LO"},
+    #GE Discovery specific tags
+    {"models": ["Discovery 670", "Infinia Hawkeye4"], "workstations": ["Hermes"],
+     "tag": 0x0011100D, "transform": "set", "value": "No scatter windows", "VR": "LO"},
+    {"models": ["Discovery 670", "Infinia Hawkeye4"], "workstations": ["Hermes"],
+     "tag": 0x00111012, "transform": "set", "value": "Simulated EM1", "VR": "LO"},
+    {"models": ["Discovery 670", "Infinia Hawkeye4"], "workstations": ["Hermes"],
+     "tag": 0x00111030, "transform": "set", "value": "Simulated EM1", "VR": "LO"},
+    {"models": ["Discovery 670", "Infinia Hawkeye4"], "workstations": ["Hermes"],
+     "tag": 0x00111050, "transform": "set", "value": "Simulated EM1", "VR": "LO"},
+    {"models": ["Discovery 670", "Infinia Hawkeye4"], "workstations": ["Hermes"],
+     "tag": 0x00551012, "transform": "emission_windows"},
+]
+# number of emission windows kept when the scatter windows are removed, might become an input
+n_emission_w=1
+
 #%%
 def changeTagValue(ds, tag, Value):
     """
@@ -53,25 +148,43 @@ def changeTagValue(ds, tag, Value):
     Remarks:
      - if Tag present in DICOM file, tag changed
      - if Tag absent, created and message printed
-     - if nested tag (up to third level: ex: ds[0x00540012][0][0x00540013][0][0x00540014]), value changed; does not work if absent 
-     - necessary to import from pydicom._dicom_dict import DicomDictionary 
-    """
-     
-     # if tag is list --> nested tag
-    if isinstance(tag, list):
-        if len(tag)==2:
-            ds[tag[0]][0][tag[1]].value=Value
-        elif len(tag)==3:
-            ds[tag[0]][0][tag[1]][0][tag[2]].value=Value
-        elif len(tag)>3:
-            print("code needs to be adapted")    
-    elif tag in ds:
-        ds[tag].value=Value
-    #if Tag not in Dicom file, message printed and new Tag is created based on DicomDictionary definitions 
+     - nested tags of any depth (ex: [0x00540012, 0x00540013, 0x00540014] for ds[0x00540012][0][0x00540013][0][0x00540014]),
+       the first item of each sequence is used; the sequences must exist
+     - the VR of a created tag is taken from the pydicom dictionary (pydicom.datadict.dictionary_VR)
+    """
+    path = tag if isinstance(tag, list) else [tag]
+    parent = tagParent(ds, path)
+    if parent is None:
+        raise KeyError("Sequence of nested tag " + str(tag) + " not found")
+    if path[-1] in parent:
+        parent[path[-1]].value=Value
+    #if Tag not in Dicom file, message printed and new Tag is created based on the DICOM dictionary definitions 
     else:
-        print("Tag "+str(tag)+" created")
+        from pydicom.datadict import dictionary_VR
+        print("Tag "+str(path[-1])+" created")
         #add_new(tag, VR, value)
-        ds.add_new(tag,DicomDictionary[tag][0], Value)
+        parent.add_new(path[-1],dictionary_VR(path[-1]), Value)
+#%%
+def tagParent(ds, path):
+    """
+    
+    Summary:
+    dataset holding the last tag of a tag path
+   
+    Parameters:
+    - ds: a DICOM file
+    - path: list of tags, each but the last one being a sequence
+     
+    Remarks:
+    - the first item of each sequence is used
+    - returns None if a sequence of the path is absent or empty
+    """
+    parent = ds
+    for tag in path[:-1]:
+        if tag not in parent or not parent[tag].value:
+            return None
+        parent = parent[tag].value[0]
+    return parent
 
 #%%
 def lastReplace(text, increment):
@@ -91,56 +204,488 @@ def lastReplace(text, increment):
     final_text=start_text+"."+str(int(end_text)+increment)
     return final_text  
 
+#%%Profiling
+def peakRSS():
+    """
+    
+    Summary:
+    peak resident memory of the process in bytes
+    
+    Parameters:
+    -
+    
+    Remarks:
+    - None if it cannot be measured (Windows without psutil)
+    """
+    if resource is not None:
+        peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak*1024
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+class Profiler:
+    """
+    
+    Summary:
+    record wall time, bytes read and written and peak RSS of every stage of a run, per file
+    
+    Parameters:
+    -
+    
+    Remarks:
+    - stages are recorded with "with profiler.stage(name, file) as record:", bytes are added to record
+    - printSummary() prints totals per stage and the slowest files
+    - saveTrace() writes a Chrome trace event file (chrome://tracing, Perfetto, speedscope) with the totals
+    """
+    def __init__(self):
+        self.records=[]
+        self._lock=threading.Lock()
+        self._origin=time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, file=None):
+        record={"stage": name, "file": None if file is None else str(file), "bytes_read": 0, "bytes_written": 0}
+        start=time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["start"]=start-self._origin
+            record["seconds"]=time.perf_counter()-start
+            record["peak_rss"]=peakRSS()
+            record["thread"]=threading.get_ident()
+            with self._lock:
+                self.records.append(record)
+
+    def summary(self):
+        totals={}
+        for record in list(self.records):
+            total=totals.setdefault(record["stage"], {"stage": record["stage"], "calls": 0, "seconds": 0.0,
+                                                      "bytes_read": 0, "bytes_written": 0, "peak_rss": None})
+            total["calls"]+=1
+            total["seconds"]+=record["seconds"]
+            total["bytes_read"]+=record["bytes_read"]
+            total["bytes_written"]+=record["bytes_written"]
+            if record["peak_rss"] is not None:
+                total["peak_rss"]=max(total["peak_rss"] or 0, record["peak_rss"])
+        return list(totals.values())
+
+    def slowestFiles(self, n=5):
+        files={}
+        for record in list(self.records):
+            if record["file"] is not None:
+                files[record["file"]]=files.get(record["file"], 0.0)+record["seconds"]
+        return sorted(files.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def printSummary(self):
+        header=["Stage", "Calls", "Total (s)", "Mean (ms)", "Read (MB)", "Written (MB)", "Peak RSS (MB)"]
+        rows=[[total["stage"], str(total["calls"]), "%.3f" % total["seconds"], "%.2f" % (1000*total["seconds"]/total["calls"]),
+               "%.1f" % (total["bytes_read"]/1e6), "%.1f" % (total["bytes_written"]/1e6),
+               "-" if total["peak_rss"] is None else "%.0f" % (total["peak_rss"]/1e6)] for total in self.summary()]
+        widths=[max(len(row[i]) for row in [header]+rows) for i in range(len(header))]
+        print("\n" + "  ".join(title.ljust(width) for title, width in zip(header, widths)))
+        print("  ".join("-"*width for width in widths))
+        for row in rows:
+            print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+        slowest=self.slowestFiles()
+        if slowest:
+            print("\nSlowest files:")
+            for file, seconds in slowest:
+                print("%8.3f s  %s" % (seconds, file))
+
+    def saveTrace(self, file_name):
+        threads={}
+        events=[]
+        for record in sorted(self.records, key=lambda record: record["start"]):
+            events.append({"name": record["stage"], "cat": "DICOM_modify", "ph": "X", "pid": os.getpid(),
+                           "tid": threads.setdefault(record["thread"], len(threads)),
+                           "ts": 1e6*record["start"], "dur": 1e6*record["seconds"],
+                           "args": {key: record[key] for key in ["file", "bytes_read", "bytes_written", "peak_rss"]}})
+        with open(file_name, "w") as traceFile:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "summary": self.summary()}, traceFile, indent=1)
+
+# Profiler of the run, None if profiling is not enabled (see --profile)
+profiler=None
+
+def enableProfiling():
+    """
+    
+    Summary:
+    start recording the stages of the run
+    
+    Parameters:
+    -
+    
+    Remarks:
+    - returns the Profiler
+    """
+    global profiler
+    profiler=Profiler()
+    return profiler
+
+@contextmanager
+def profileStage(name, file=None):
+    """
+    
+    Summary:
+    record a stage with the run profiler, if profiling is enabled
+    
+    Parameters:
+    - name: the name of the stage
+    - file: the file processed by the stage, if any
+    
+    Remarks:
+    - yields a dict where bytes_read and bytes_written can be set; ignored if profiling is not enabled
+    """
+    if profiler is None:
+        yield {}
+    else:
+        with profiler.stage(name, file) as record:
+            yield record
+
+#%%Header parsing
+# key = value (MetaImage) or !key := value (interfile) header line
+header_line=re.compile(r"^\s*!?\s*([^:=]*?)\s*:?=\s*(.*?)\s*$")
+# interfile number format: numpy kind and default number of bytes per pixel
+interfile_formats={"unsigned integer": ("u", 2), "signed integer": ("i", 2), "float": ("f", 4), "short float": ("f", 4),
+                   "long float": ("f", 8)}
+# keys giving the number of images of an interfile, by order of preference
+interfile_n_images=["number of projections", "matrix size[3]", "total number of images", "number of images", "number of slices"]
+# MetaImage element types as numpy types
+met_types={"MET_CHAR": "i1", "MET_UCHAR": "u1", "MET_SHORT": "i2", "MET_USHORT": "u2", "MET_INT": "i4", "MET_UINT": "u4",
+           "MET_LONG": "i4", "MET_ULONG": "u4", "MET_LONG_LONG": "i8", "MET_ULONG_LONG": "u8", "MET_FLOAT": "f4",
+           "MET_DOUBLE": "f8"}
+
+def parseHeader(headerFileName):
+    """
+    Summary:
+    read all key/value pairs of an interfile (.hdr) or MetaImage (.mhd) header in one pass
+   
+    Parameters:
+    - headerFileName: the header file name
+     
+    Remarks:
+    - interfile keys are lower case, without "!" and with single spaces ("matrix size[1]"); MetaImage keys as written
+    - MetaImage: parsing stops at ElementDataFile (always the last field); the header length in bytes is
+      given as "HeaderLength" and the file names following "ElementDataFile = LIST" as "ElementDataFileList"
+    - headers are cached by path, modification time and size: the returned dict must not be modified
+    """
+    stat=os.stat(headerFileName)
+    return _parseHeader(os.path.abspath(headerFileName), stat.st_mtime_ns, stat.st_size)
+
+@functools.lru_cache(maxsize=4096)
+def _parseHeader(headerFileName, mtime, size):
+    interfile=not headerFileName.lower().endswith((".mhd", ".mha"))
+    fields={}
+    with profileStage("parse_header", headerFileName) as record, open(headerFileName, "rb") as headerFile:
+        for line in headerFile:
+            match=header_line.match(line.decode("latin-1"))
+            if match is None:
+                continue
+            key, value=match.groups()
+            if interfile:
+                key=re.sub(r"\s+", " ", key.lower()).replace(" [", "[")
+            fields[key]=value
+            if not interfile and key == "ElementDataFile":
+                fields["HeaderLength"]=headerFile.tell()
+                if value.split()[0] == "LIST":
+                    list_files=[item.decode("latin-1").strip() for item in headerFile]
+                    fields["ElementDataFileList"]=[item for item in list_files if item]
+                break
+        record["bytes_read"]=headerFile.tell()
+    return fields
+
+def headerValue(fields, key, headerFileName, default=None):
+    """
+    Summary:
+    value of a key of a parsed header
+   
+    Parameters:
+    - fields: the header dict returned by parseHeader
+    - key: the key
+    - headerFileName: the header file name, for the error message
+    - default: the value if the key is absent; if None, a missing key raises ValueError
+     
+    Remarks:
+    -
+    """
+    if key in fields:
+        return fields[key]
+    if default is None:
+        raise ValueError("Key \"" + key + "\" missing in header " + str(headerFileName))
+    return default
+
 #%%
 def readHDR(hdrFileName):
     """
     Summary:
-    extract the raw data filename, endianess, dimensions and type from an interfile header (.hdr)
+    extract the raw data filename, endianess, dimensions, type, data offset and compression from an interfile header (.hdr)
    
     Parameters:
     - hdrFileName: the interfile header file name
      
+    Remarks:
+    - the number of images is taken from "number of projections" or, failing that, "matrix size [3]",
+      "total number of images", "number of images" or "number of slices" (1 if none is given)
+    - number formats: (un)signed integer of 1, 2, 4 or 8 bytes and (short/long) float; not bit or ASCII data
+    - the byte order is big endian if not given, as in the interfile standard
+    - the data offset is taken from "data offset in bytes" or, failing that, "data starting block" (2048 bytes blocks)
+    - gzipped raw data: the data file name ends with .gz, or only the .gz of the data file exists;
+      the data offset is then counted in the uncompressed data
+    """
+    fields = parseHeader(hdrFileName)
+    dimX = int(headerValue(fields, "matrix size[1]", hdrFileName))
+    dimY = int(headerValue(fields, "matrix size[2]", hdrFileName))
+    dimZ = int(next((fields[key] for key in interfile_n_images if key in fields), 1))
+    endianess = "<" if fields.get("imagedata byte order", "BIGENDIAN").upper() == "LITTLEENDIAN" else ">"
+    number_format = fields.get("number format", "unsigned integer").lower()
+    if number_format not in interfile_formats:
+        raise ValueError("Number format \"" + number_format + "\" not supported in header " + str(hdrFileName))
+    dtype, bits = interfile_formats[number_format]
+    bits = fields.get("number of bytes per pixel", bits)
+    if "data offset in bytes" in fields:
+        offset = int(fields["data offset in bytes"])
+    else:
+        offset = 2048*int(fields.get("data starting block", 0))
+    #data file name relative to the header folder
+    dataFileName = os.path.join(os.path.dirname(hdrFileName), headerValue(fields, "name of data file", hdrFileName))
+    if not os.path.exists(dataFileName) and os.path.exists(dataFileName+".gz"):
+        dataFileName = dataFileName+".gz"
+    compressed = dataFileName.lower().endswith(".gz")
+
+    return (dimZ,dimY,dimX), dataFileName, np.dtype(endianess+dtype+str(bits)), offset, compressed
+
+#%%
+def dataOffset(dataFileName, offset, nbytes):
+    """
+    Summary:
+    resolve the position of the raw data in a data file
+   
+    Parameters:
+    - dataFileName: the raw data file name
+    - offset: the header size in bytes, -1 if the data is at the end of the file
+    - nbytes: the size of the raw data in bytes
+     
     Remarks:
     -
     """
-    hdrFile = open(hdrFileName, "r")
-    for line in hdrFile:
-        if re.search("name of data file", line):
-            line = line.rstrip("\n\r")
-            dataFileName = re.split("=", line)[-1]
-        if re.search("matrix size \[1\]", line): #"\[" necessary because regular expression if not "[" in line works
-            line = line.rstrip("\n\r")
-            dimX = re.split("=", line)[-1]
-        if re.search("matrix size \[2\]", line):
-            line = line.rstrip("\n\r")
-            dimY = re.split("=", line)[-1]
-        if re.search("number of projections", line):
-            line = line.rstrip("\n\r")
-            line = line.rstrip("\n\r")
-            dimZ = re.split("=", line)[-1]
-        if re.search("imagedata byte order", line):
-           line = line.rstrip("\n\r")
-           words = re.split("=", line)[-1]
-           if re.match("LITTLEENDIAN", words):
-               endianess = "<"
-           if re.match("BIGENDIAN", words):
-               endianess = ">"      
-        if re.search("number format", line):
-            line = line.rstrip("\n\r")
-            words = re.split("=", line)[-1]
-            if re.match("unsigned integer", words):
-                dtype = "u"
-            if re.match("signed integer", words):
-                dtype = "i"
-        if re.search("number of bytes per pixel", line):
-            line=line.rstrip("\n\r")
-            bits=re.split("=", line)[-1]
-    hdrFile.close()
-
-    return (int(dimZ),int(dimY),int(dimX)), dataFileName, np.dtype(endianess+dtype+bits)
-
-#%%
-def readRawHDRData(hdrFileName):
+    if offset < 0:
+        offset = os.path.getsize(dataFileName)-nbytes
+    return offset
+
+#%%
+def readRawData(dataFileName, dimensions, dtype, offset=0, mmap=False):
+    """
+    Summary:
+    convert raw data from a file into a numpy array
+   
+    Parameters:
+    - dataFileName: the raw data file name
+    - dimensions: the dimensions of the data (n_images x row x col)
+    - dtype: the numpy type of the data
+    - offset: the header size in bytes, -1 if the data is at the end of the file
+    - mmap: if True, the file is memory-mapped and a read-only view is returned instead of a copy
+     
+    Remarks:
+    - with mmap, only the slices or frames actually used are read from disk
+    """
+    count = int(np.prod(dimensions))
+    offset = dataOffset(dataFileName, offset, count*dtype.itemsize)
+    if mmap:
+        return np.memmap(dataFileName, dtype=dtype, mode="r", offset=offset, shape=dimensions, order='C')
+    arrayFlat = np.fromfile(dataFileName, dtype=dtype, count=count, offset=offset)
+    return np.reshape(arrayFlat, dimensions, order='C')
+
+#%%
+class RawFileStack:
+    """
+    Summary:
+    read-only volume stored as a list of raw files, each holding the same number of slices
+   
+    Parameters:
+    - dataFileNames: the raw data file names, in slice order
+    - dimensions: the dimensions of the whole volume (n_images x row x col)
+    - dtype: the numpy type of the data
+    - offset: the header size in bytes of every file, -1 if the data is at the end of the file
+    - compressed: if True, every file is zlib or gzip compressed, see CompressedRawFile
+     
+    Remarks:
+    - files are memory-mapped (or decompressed) when indexed, so only the requested slices are read
+    - indexing along the first axis returns numpy arrays; np.asarray() gives the whole volume
+    """
+    def __init__(self, dataFileNames, dimensions, dtype, offset=0, compressed=False):
+        self.dataFileNames = list(dataFileNames)
+        self.shape = tuple(dimensions)
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self.compressed = compressed
+        self.n_per_file = self.shape[0]//len(self.dataFileNames)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _file(self, index):
+        dimensions = (self.n_per_file,)+self.shape[1:]
+        if self.compressed:
+            return CompressedRawFile(self.dataFileNames[index], dimensions, self.dtype, offset=max(self.offset, 0))
+        return readRawData(self.dataFileNames[index], dimensions, self.dtype, self.offset, mmap=True)
+
+    def _slice(self, index):
+        return self._file(index//self.n_per_file)[index % self.n_per_file]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first, slice):
+            indices = range(*first.indices(self.shape[0]))
+            array = np.stack([self._slice(i) for i in indices]) if len(indices) else np.empty((0,)+self.shape[1:], self.dtype)
+            return array[(slice(None),)+rest]
+        if first < 0:
+            first += self.shape[0]
+        return self._slice(first)[rest]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+#%%
+class CompressedRawFile:
+    """
+    Summary:
+    read-only volume stored as zlib (.zraw) or gzip (.raw.gz) compressed raw data, decompressed on demand
+   
+    Parameters:
+    - dataFileName: the compressed data file name
+    - dimensions: the dimensions of the data (n_images x row x col)
+    - dtype: the numpy type of the data
+    - offset: the size in bytes of the uncompressed data before the images
+    - file_offset: the position of the compressed data in the file (e.g. after the header of a LOCAL mhd file)
+     
+    Remarks:
+    - the data is streamed: only the slices up to the last one requested are decompressed, straight into the
+      returned array, the file is never inflated into memory as a whole
+    - the decompressor state is saved every checkpoint_slices slices, so going back costs at most that many
+      slices, and the last cache_slices slices read are kept
+    - indexing along the first axis returns numpy arrays; np.asarray() gives the whole volume
+    - safe to share between threads
+    """
+    checkpoint_slices = 16
+    cache_slices = 8
+    read_size = 1 << 16
+
+    def __init__(self, dataFileName, dimensions, dtype, offset=0, file_offset=0):
+        self.dataFileName = dataFileName
+        self.shape = tuple(dimensions)
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self.file_offset = file_offset
+        self.slice_bytes = int(np.prod(self.shape[1:]))*self.dtype.itemsize
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._checkpoints = {}
+        self._index = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _restart(self, index):
+        """resume decompression at slice index from the closest checkpoint before it"""
+        import zlib
+        start = max([item for item in self._checkpoints if item <= index], default=None)
+        if start is None:
+            self._inflater = zlib.decompressobj(32+zlib.MAX_WBITS)
+            self._position = self.file_offset
+            self._input = b""
+            self._index = 0
+            self._inflate(memoryview(bytearray(self.offset)))
+        else:
+            inflater, self._position, self._input = self._checkpoints[start]
+            self._inflater = inflater.copy()
+            self._index = start
+        self._skip(index)
+
+    def _skip(self, index):
+        """decompress and drop the slices up to index"""
+        skipped = memoryview(bytearray(self.slice_bytes))
+        while self._index < index:
+            self._next(skipped)
+
+    def _inflate(self, output):
+        """decompress exactly len(output) bytes into output"""
+        import zlib
+        filled = 0
+        with open(self.dataFileName, "rb") as dataFile:
+            while filled < len(output):
+                if not self._input:
+                    dataFile.seek(self._position)
+                    self._input = dataFile.read(self.read_size)
+                    self._position += len(self._input)
+                    if not self._input:
+                        raise ValueError("Compressed data " + str(self.dataFileName) + " is shorter than "
+                                         + str(self.shape) + " " + str(self.dtype))
+                chunk = self._inflater.decompress(self._input, len(output)-filled)
+                self._input = self._inflater.unconsumed_tail
+                if self._inflater.eof:
+                    # next member of a multi-member gzip file
+                    self._input = self._inflater.unused_data
+                    self._inflater = zlib.decompressobj(32+zlib.MAX_WBITS)
+                output[filled:filled+len(chunk)] = chunk
+                filled += len(chunk)
+
+    def _next(self, output):
+        if self._index % self.checkpoint_slices == 0 and self._index not in self._checkpoints:
+            self._checkpoints[self._index] = (self._inflater.copy(), self._position, self._input)
+        self._inflate(output)
+        self._index += 1
+
+    def _slices(self, indices):
+        array = np.empty((len(indices),)+self.shape[1:], dtype=self.dtype)
+        output = memoryview(array.reshape(-1).view(np.uint8))
+        with self._lock:
+            for position, index in enumerate(indices):
+                destination = output[position*self.slice_bytes:(position+1)*self.slice_bytes]
+                if index in self._cache:
+                    destination[:] = self._cache[index]
+                    continue
+                if self._index is None or index < self._index:
+                    self._restart(index)
+                else:
+                    self._skip(index)
+                self._next(destination)
+                self._cache[index] = bytes(destination)
+                if len(self._cache) > self.cache_slices:
+                    del self._cache[next(iter(self._cache))]
+        return array
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first, slice):
+            return self._slices(range(*first.indices(self.shape[0])))[(slice(None),)+rest]
+        if first < 0:
+            first += self.shape[0]
+        if not 0 <= first < self.shape[0]:
+            raise IndexError("index " + str(first) + " out of range for " + str(self.shape[0]) + " slices")
+        return self._slices([first])[0][rest]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+#%%
+def readRawHDRData(hdrFileName, mmap=False):
     """
     Summary:
     convert the raw data from an interfile into a numpy array
@@ -148,54 +693,66 @@ def readRawHDRData(hdrFileName):
     Parameters:
     - path: the path to the hdr file and the raw data file
     - hdrFileName: the interfile header file name
+    - mmap: if True, the raw data file is memory-mapped instead of read into memory
      
     Remarks:
-    -
+    - gzipped raw data is decompressed into the returned array or, with mmap, a CompressedRawFile is returned
+      so that only the images used are decompressed
     """
-    dimensions, dataFileName, dtype = readHDR(hdrFileName)
-    arrayFlat = np.fromfile(dataFileName,dtype=dtype)
-    array3D = np.reshape(arrayFlat, dimensions, order='C')
-    return array3D 
+    dimensions, dataFileName, dtype, offset, compressed = readHDR(hdrFileName)
+    if compressed:
+        volume = CompressedRawFile(dataFileName, dimensions, dtype, offset=max(offset, 0))
+        return volume if mmap else np.asarray(volume)
+    return readRawData(dataFileName, dimensions, dtype, offset, mmap)
 #%%
 def readMHD(mhdFileName):
     """
     Summary:
-    extract the raw data filename, endianess, dimensions and type from an mhd header (.mhd)
+    extract the raw data filename, endianess, dimensions, type, data offset and compression from an mhd header (.mhd)
    
     Parameters:
     - mhdFileName: the interfile header file name
      
     Remarks:
-    -
+    - all MET_* element types are supported, single channel only
+    - ElementDataFile = LOCAL: the data follows the header in the mhd file itself
+    - ElementDataFile = LIST: the data file names are listed on the following lines, a list is returned
+    - ElementDataFile = PATTERN START STOP STEP: printf-style series of data files (e.g. slice%03d.raw 1 40 1),
+      a list is returned
+    - the data offset is HeaderSize (-1 if the data is at the end of the file), added to the header length for LOCAL
+    - CompressedData = True: zlib compressed data (.zraw), the data offset is then the position of the compressed
+      data in the file (the header length for LOCAL, 0 otherwise)
     """
-    mhdFile = open(mhdFileName, "r")
-    for line in mhdFile:
-        if re.search("ElementDataFile", line):
-            line = line.rstrip("\n\r")
-            dataFileName = re.split(" ", line)[-1]
-        if re.search("DimSize", line):
-            line = line.rstrip("\n\r")
-            dimX,dimY,dimZ = re.split(" ", line)[-3:]
-        if re.search("BinaryDataByteOrderMSB", line) or re.search("ElementByteOrderMSB", line):
-           line = line.rstrip("\n\r")
-           words = re.split(" ", line)[-1]
-           if re.match("False", words):
-               endianess = "<"
-           if re.match("True", words):
-               endianess = ">"      
-        if re.search("ElementType", line):
-            line = line.rstrip("\n\r")
-            if re.split(" ", line)[-1]=="MET_USHORT":
-                dtype_bits = "u2"
-            if re.split(" ", line)[-1]=="MET_SHORT":
-                dtype_bits = "i2"
-                
-    mhdFile.close()
-
-    return (int(dimZ),int(dimY),int(dimX)), dataFileName, np.dtype(endianess+dtype_bits)
-
-#%%
-def readRawMHDData(mhdFileName):
+    fields = parseHeader(mhdFileName)
+    dimensions = [int(item) for item in headerValue(fields, "DimSize", mhdFileName).split()]
+    dimX, dimY, dimZ = (dimensions+[1, 1])[:3]
+    msb = fields.get("ElementByteOrderMSB", fields.get("BinaryDataByteOrderMSB", "False"))
+    endianess = ">" if msb.lower() == "true" else "<"
+    element_type = headerValue(fields, "ElementType", mhdFileName)
+    if element_type not in met_types or int(fields.get("ElementNumberOfChannels", 1)) != 1:
+        raise ValueError("Element type " + element_type + " not supported in header " + str(mhdFileName))
+    compressed = fields.get("CompressedData", "False").lower() == "true"
+    offset = 0 if compressed else int(fields.get("HeaderSize", 0))
+    #data file names relative to the header folder
+    dataFileName = headerValue(fields, "ElementDataFile", mhdFileName)
+    pattern = dataFileName.split()
+    if dataFileName == "LOCAL":
+        dataFileName = mhdFileName
+        if offset >= 0:
+            offset = offset+fields["HeaderLength"]
+    elif "ElementDataFileList" in fields:
+        dataFileName = [os.path.join(os.path.dirname(mhdFileName), item) for item in fields["ElementDataFileList"]]
+    elif len(pattern) >= 4 and "%" in pattern[0]:
+        start, stop, step = [int(item) for item in pattern[1:4]]
+        dataFileName = [os.path.join(os.path.dirname(mhdFileName), pattern[0] % number)
+                        for number in range(start, stop+(1 if step > 0 else -1), step)]
+    else:
+        dataFileName = os.path.join(os.path.dirname(mhdFileName), dataFileName)
+
+    return (dimZ,dimY,dimX), dataFileName, np.dtype(endianess+met_types[element_type]), offset, compressed
+
+#%%
+def readRawMHDData(mhdFileName, mmap=False):
     """
     Summary:
     convert the raw data from a mhd file into a numpy array
@@ -203,252 +760,2440 @@ def readRawMHDData(mhdFileName):
     Parameters:
     - path: the path to the mhd file and the raw data file
     - mhdFileName: the interfile header file name
+    - mmap: if True, the raw data file(s) are memory-mapped instead of read into memory
      
     Remarks:
-    -
+    - with a list or series of data files and mmap, a RawFileStack is returned instead of a numpy array
+    - compressed data is decompressed into the returned array or, with mmap, a CompressedRawFile is returned
+      so that only the images used are decompressed
     """
-    dimensions, dataFileName, dtype = readMHD(mhdFileName)
-    arrayFlat = np.fromfile(dataFileName,dtype=dtype)
-    array3D = np.reshape(arrayFlat, dimensions, order='C')
-    return array3D 
+    dimensions, dataFileName, dtype, offset, compressed = readMHD(mhdFileName)
+    if isinstance(dataFileName, list):
+        stack = RawFileStack(dataFileName, dimensions, dtype, offset, compressed)
+        return stack if mmap else np.asarray(stack)
+    if compressed:
+        volume = CompressedRawFile(dataFileName, dimensions, dtype, file_offset=offset)
+        return volume if mmap else np.asarray(volume)
+    return readRawData(dataFileName, dimensions, dtype, offset, mmap)
 
-#%%image_to_array
-def image_to_array(images):
+#%%
+def pixelShapeDtype(ds):
     """
     Summary:
-    convert images (hdr,mhd or dcm) file into a numpy array
-     
+    compute the shape and numpy type of the pixel data of a DICOM file from its header
+   
     Parameters:
-    - images: the name of the image file
-        
+    - ds: a DICOM file
+     
     Remarks:
-    -
+    - (frames x row x col) if NumberOfFrames > 1, (row x col) otherwise, as returned by ds.pixel_array
     """
-    if images.lower().endswith("dcm") or images.lower().endswith("ima"):
-        ds = pydicom.read_file(images)
-        array= ds.pixel_array
-    elif images.lower().endswith("hdr"):
-        array=readRawHDRData(images)
-    elif images.lower().endswith("mhd"):
-        array=readRawMHDData(images)
-    return array
-#%% 
-def ctAddSim(input_folder, sim_input_folder, output_folder):
+    n_frames = int(ds.get("NumberOfFrames", 1) or 1)
+    shape = (ds.Rows, ds.Columns)
+    if n_frames > 1:
+        shape = (n_frames,)+shape
+    endianess = "<" if ds.is_little_endian else ">"
+    dtype = "i" if ds.PixelRepresentation == 1 else "u"
+    return shape, np.dtype(endianess+dtype+str(ds.BitsAllocated//8))
+
+#%%
+def pixelDataOffset(dcmFile, ds):
     """
-    
     Summary:
-    create new CT DICOM files with new images
-    
+    find the position of the pixel data value in a DICOM file
+   
     Parameters:
-    - input_folder: path to the folder containing the original CT DICOM files
-    - sim_input_folder: path to the folder containing the simulated images (dcm (or IMA) or hdr or mhd)
-    - output_folder: path to the folder where the modified CT DICOM files are to be saved
+    - dcmFile: the DICOM file object, positioned at the start of the PixelData element
+      (as left by pydicom.read_file with stop_before_pixels=True)
+    - ds: the DICOM file header read from dcmFile
+     
+    Remarks:
+    - returns None if the next element is not PixelData (7FE0,0010)
+    """
+    endianess = "<" if ds.is_little_endian else ">"
+    tag = dcmFile.read(4)
+    if len(tag) < 4 or struct.unpack(endianess+"HH", tag) != (0x7FE0, 0x0010):
+        return None
+    if not ds.is_implicit_VR:
+        #OB/OW: 2 bytes VR, 2 reserved bytes, 4 bytes length
+        dcmFile.read(4)
+    dcmFile.read(4)
+    return dcmFile.tell()
+
+#%%
+def readRawDCMData(dcmFileName):
+    """
+    Summary:
+    memory-map the pixel data of an uncompressed DICOM file
    
+    Parameters:
+    - dcmFileName: the DICOM file name
+     
     Remarks:
-    - one file containing all simulated projection images or one file for each projection image
-    - simulated image dimensions as row x col x n_images or if one image per file row x col
-      
+    - compressed transfer syntaxes cannot be mapped; the decoded pixel_array is returned instead
     """
-    list_files=os.listdir(input_folder)
-    list_sim_trans=os.listdir(sim_input_folder)
-    list_sim=[]
-    image_extension=["dcm","ima","mhd","hdr"]
-    for item in image_extension:
-        sim=[file for file in list_sim_trans if file.lower().endswith(item)]
-        list_sim.extend(sim)
-    n_list_sim=len(list_sim)
-    list_sim=natsorted(list_sim)
-    for [index, file] in enumerate(list_files):
-        os.chdir(input_folder)
-        file_name_modified=str("modified_"+file)
-        ds=pydicom.read_file(file)
-        #modify tags
-        val=ds[0x00080018].value
-        val=lastReplace(val, 10000)
-        changeTagValue(ds,0x00080018,val)
-        val=ds[0x0020000d].value
-        val=lastReplace(val, 10000)
-        changeTagValue(ds,0x0020000d,val)
-        val=ds[0x0020000e].value
-        val=lastReplace(val, 10000)
-        changeTagValue(ds,0x0020000e,val)
-        # add simulated images 
-        os.chdir(sim_input_folder)
-        if n_list_sim == 1:
-            array=image_to_array(list_sim[0])
-            array_short = array[index,:,:] 
-            ds.PixelData=array_short.tostring()
-        else:
-            array=image_to_array(list_sim[index])
-            ds.PixelData=array.tostring()            
-        #save files
-        os.chdir(output_folder)
-        ds.save_as(file_name_modified)
+    with open(dcmFileName, "rb") as dcmFile:
+        ds = pydicom.read_file(dcmFile, stop_before_pixels=True)
+        offset = None
+        if not ds.file_meta.TransferSyntaxUID.is_compressed:
+            offset = pixelDataOffset(dcmFile, ds)
+    if offset is None:
+        return pydicom.read_file(dcmFileName).pixel_array
+    shape, dtype = pixelShapeDtype(ds)
+    return readRawData(dcmFileName, shape, dtype, offset, mmap=True)
+
 #%%
-def spectAddSim(input_folder, sim_input_folder, output_folder, model, workstation):
+def readTemplate(file_name):
     """
-    
     Summary:
-    create new SPECT DICOM files with new images
-    
+    read an original DICOM file used as template, without loading its pixel data
+   
     Parameters:
-    - input_folder: path to the folder containing the original SPECT DICOM files
-    - sim_input_folder: path to the folder containing the simulated images (dcm (or IMA) or hdr or mhd)
-    - output_folder: path to the folder where the modified SPECT DICOM files are to be saved
-    - model: name of the SPECTCT model, to be chosen among list_models
-    - workstation: name of the reconstruction workstation, to be chosen among list_stations
-    
+    - file_name: the DICOM file name
+     
     Remarks:
-    - one DICOM file containing all energy windows or one file for each window
-    - one file containing all simulated energy windows or one file for each window
-    - simulatde image dimensions as row x col x frames or if one image per file row x col
-    - if workstation = "Hermes", only first energy window is kept (the scatter windows are removed) and related tags are modified
-    
+    - PixelData (and any other value larger than 64 KB) is deferred: only read if accessed
+    - use pixelShapeDtype(ds) instead of ds.pixel_array, and writeDICOM to replace the pixel data
+    - the bytes read recorded for profiling are the file size minus the deferred values
     """
-    list_files=os.listdir(input_folder)
-    #just keep first energy window if reconstruction on Hermes
-    if (model == "Optima 640" or model == "Brightview XCT") and workstation == "Hermes":
-        list_files=[list_files[0]]
-    n_files=len(list_files)
-    list_sim_trans=os.listdir(sim_input_folder)
-    list_sim=[]
-    image_extension=["dcm","ima","mhd","hdr"]
-    for item in image_extension:
-        sim=[file for file in list_sim_trans if file.lower().endswith(item)]
-        list_sim.extend(sim)
-    n_list_sim=len(list_sim)
-    list_sim=natsorted(list_sim)
-    for [index, file] in enumerate(list_files):
-       os.chdir(input_folder)
-       file_name_modified=str("modified_"+file)
-       ds=pydicom.read_file(file)
-       n_energy_w=ds[0x00540011].value
-       n_frames=ds[0x00280008].value
-       # might become an input
-       n_emission_w=1
-       ### modify of tags to prevent original overwriting ###
-       val=ds[0x00080018].value
-       val=lastReplace(val, 10000)
-       changeTagValue(ds,0x00080018,val)
-       val=ds[0x0020000d].value
-       val=lastReplace(val, 10000)
-       changeTagValue(ds,0x0020000d,val)
-       val=ds[0x0020000e].value
-       val=lastReplace(val, 10000)
-       changeTagValue(ds,0x0020000e,val)
-       if model == "Symbia Intevo Bold":
-           if "Advanced" not in ds[0x0008103E].value:
-               #0X00611077 --> reference to series of Advanced NM (0X0020000E)
-               val=ds[0x00611077].value
-               val=lastReplace(val, 10000)
-               changeTagValue(ds,0x00611077,val)
-               #0X00611078 --> reference to Media storage SOP instance UID of Advanced NM (0X00020003)
-               val=ds[0x00611078].value
-               val=lastReplace(val, 10000)
-               changeTagValue(ds,0x00611078,val)
-       ### add simulated images ###
-       os.chdir(sim_input_folder)
-       if (n_list_sim == n_files) :           
-           array=image_to_array(list_sim[index])
-       elif (n_list_sim == 1 and n_files > 1):
-           array=image_to_array(list_sim[0])
-           array=array[(0+int(n_frames*index)):int(n_frames*(1+index)),:,:]
-       elif (n_list_sim > 1 and n_files == 1):
-           array=np.empty(shape=ds.pixel_array.shape, dtype=ds.pixel_array.dtype)
-           for i in range(n_list_sim):
-               array[(0+int(n_frames/n_energy_w*index)):int(n_frames/n_energy_w*(1+index)),:,:]=image_to_array(list_sim[i])
-       ds.PixelData=array.tostring()
-       ### modify tags related to Hermes ###
-       if workstation == "Hermes":
-           if model != "Optima 640" or model != "Brightview XCT":
-               #remove or modify tags related to scatter windows
-               changeTagValue(ds,0x00280008,int(ds[0x00280008].value*(n_emission_w/n_energy_w)))
-               changeTagValue(ds,0x00540010,ds[0x00540010].value[0:int(len(ds[0x00540010].value)*(n_emission_w/n_energy_w))])
-               changeTagValue(ds,0x00540011,n_emission_w)
-               changeTagValue(ds,0x00540012,ds[0x00540012][0:n_emission_w])
-               changeTagValue(ds,0x00540020,ds[0x00540020].value[0:int(len(ds[0x00540020].value)*(n_emission_w/n_energy_w))])
-               changeTagValue(ds,0x00540050,ds[0x00540050].value[0:int(len(ds[0x00540050].value)*(n_emission_w/n_energy_w))])
-               changeTagValue(ds,0x00540090,ds[0x00540090].value[0:int(len(ds[0x00540090].value)*(n_emission_w/n_energy_w))]) 
-               if model == "Symbia T2" or model == "Symbia Intevo Bold":   
-                   changeTagValue(ds,0x00351001,"Simulated EM1")
-               elif model == "Discovery 670" or model == "Infinia Hawkeye4":
-                   # GE Discovery specific tags
-                   changeTagValue(ds,0x0011100D,"No scatter windows")
-                   changeTagValue(ds,0x00111012,"Simulated EM1")
-                   changeTagValue(ds,0x00111030,"Simulated EM1")
-                   changeTagValue(ds,0x00111050,"Simulated EM1")
-                   changeTagValue(ds,0x00551012,ds[0x00551012][0:n_emission_w])   
-           elif model == "Optima 640":
-               # GE Optima specific tags
-               changeTagValue(ds,0x0011100D,"No scatter windows")  
-               changeTagValue(ds,0x00111012,"Simulated EM1")
-               changeTagValue(ds,0x00111030,"Simulated EM1")
-               changeTagValue(ds,0x00111050,"Simulated EM1")
-           else:
-               print("Model not recognised or not implemented")
-               sys.exit()
-       # Save file
-       os.chdir(output_folder)
-       ds.save_as(file_name_modified)
-#%%Parsing
-# Parse the arguments
-parser = argparse.ArgumentParser(description = "Create a copy of original DICOM files with modified images")
-parser.add_argument("-m", "--model", help="\"Brightview XCT\", \"Discovery 670\", \"Infinia Hawkeye4\", \"Optima 640\", \"Symbia T2\", \"Symbia Intevo Bold\"", required=True)
-parser.add_argument("-w", "--workstation", help="\"Hermes\", \"Jetstream\", \"Syngo\", \"Xeleris\"", required=True)
-parser.add_argument("-i", "--input_folder", help = "Path to the folder containing the original DICOM files and the simulated images \"C:\\Users\\...\"", required=True)
-parser.add_argument("-o", "--output_folder", help = "Optional: Path to the folder where the modified images are to be saved \"C:\\Users\\...\"", required=False)
-parser._optionals.title = "Arguments"
-args = parser.parse_args()
-
-# Process the file
-# Input folders
-path_CT=Path(args.input_folder).joinpath("CT")
-path_SPECT=Path(args.input_folder).joinpath("SPECT")
-path_CT_sim=Path(args.input_folder).joinpath("sim_CT")
-path_SPECT_sim=Path(args.input_folder).joinpath("sim_SPECT")
-# Output folders
-if args.output_folder:
-    path_output_folder=Path(args.output_folder)
-else:
-    path_output_folder=Path(args.input_folder).joinpath("Output")
-    path_output_folder.mkdir()
-path_modified_CT=path_output_folder.joinpath("CT_modified")
-path_modified_CT.mkdir()
-path_modified_SPECT=path_output_folder.joinpath("SPECT_modified")
-path_modified_SPECT.mkdir()
-
-# Are model and workstation recognised?
-if args.model not in list_models:
-    print("The system model " + args.model + " is not recognised. \nPlease check the spelling or try another name. \nThe recognised systems are:")
-    for item in list_models:
-        print("\n" + item)
-    sys.exit()
-if args.workstation not in list_stations:
-    print("The workstation " + args.workstation + " is not recognised. \nPlease check the spelling or try another name. \nThe recognised workstations are:")
-    for item in list_stations:
-        print("\n" + item)
-    sys.exit()
-if args.workstation and args.model:
-    print("\nOriginal acquisition system: " + args.model + " to be reconstructed on " + args.workstation
-          + "\nOriginal DICOM files in folders " + str(path_CT) + " and " + str(path_SPECT))
+    from pydicom.dataelem import RawDataElement
+    with profileStage("read_template", file_name) as record:
+        ds = pydicom.read_file(file_name, defer_size=65536)
+        record["bytes_read"] = os.path.getsize(file_name) - sum(element.length for element in ds.values()
+                                                                if isinstance(element, RawDataElement) and element.value is None)
+        return ds
 
-# Are original and simulated images provided?
-if os.listdir(path_CT)==[] :
-    print("No CT files provided")
-elif os.path.isdir(path_CT_sim):
-    if not os.listdir(path_CT_sim)==[]:
-        print("\nImporting simulated CT images from " + str(path_CT_sim))
-        ctAddSim(path_CT, path_CT_sim, path_modified_CT)
-        print("\nCT files successfully modified and saved in " + str(path_modified_CT))
-    else:
-        print("\nNo simulated CT images were found")
-if os.listdir(path_SPECT)==[]:
-    print("No SPECT files provided")
-elif os.path.isdir(path_SPECT_sim):
-    if not os.listdir(path_SPECT_sim)==[]:
-        print("\nImporting simulated SPECT images from " + str(path_SPECT_sim))
-        spectAddSim(path_SPECT, path_SPECT_sim, path_modified_SPECT, args.model, args.workstation)
-        print("\nSPECT files successfully modified and saved in " + str(path_modified_SPECT))
+#%%Pixel conversion
+def valueRange(array, chunk_frames=16):
+    """
+    Summary:
+    minimum, maximum and whether all values are integers, computed chunk by chunk
+   
+    Parameters:
+    - array: the images (frames x row x col or row x col), e.g. a memory-mapped view
+    - chunk_frames: number of frames read at a time
+     
+    Remarks:
+    - returns (minimum, maximum, integral); NaN values are ignored
+    """
+    if array.ndim > 2:
+        chunks = (np.asarray(array[i:i+chunk_frames]) for i in range(0, len(array), chunk_frames))
     else:
-        print("\nNo simulated CT images were found")
-print("\n")
\ No newline at end of file
+        chunks = [np.asarray(array)]
+    minimum, maximum, integral = np.inf, -np.inf, True
+    for chunk in chunks:
+        if chunk.size == 0:
+            continue
+        minimum = min(minimum, float(np.nanmin(chunk)))
+        maximum = max(maximum, float(np.nanmax(chunk)))
+        if integral and not np.issubdtype(chunk.dtype, np.integer):
+            integral = bool(np.all(np.isnan(chunk) | (np.rint(chunk) == chunk)))
+    return minimum, maximum, integral
+
+def mergeRanges(ranges):
+    """
+    Summary:
+    value range of several arrays from their valueRange
+   
+    Parameters:
+    - ranges: list of (minimum, maximum, integral)
+     
+    Remarks:
+    -
+    """
+    ranges = list(ranges)
+    return (min(item[0] for item in ranges), max(item[1] for item in ranges), all(item[2] for item in ranges))
+#%%
+class PixelConversion:
+    """
+    Summary:
+    conversion of simulated images to the pixel type of a DICOM file
+   
+    Parameters:
+    - ds: the DICOM file header, giving the shape and the type (BitsAllocated, BitsStored, PixelRepresentation)
+    - array: the images to be converted (frames x row x col or row x col)
+    - value_range: (minimum, maximum, integral) of the whole simulated volume, see valueRange, or a function
+      returning it, only called if needed; computed from array if None
+     
+    Remarks:
+    - raises ValueError if the array does not have the rows, columns and number of frames of ds
+    - integer values that fit the stored range are cast as they are (the template rescale applies to them);
+      other modalities than CT: float values that fit are rounded, so that counts keep their scale
+    - otherwise (CT float values, or out of range) the values are mapped onto the stored range: integer values
+      whose span fits it are only shifted (slope 1, lossless), other values have [minimum, maximum] linearly
+      mapped onto the whole stored range
+      - CT: RescaleSlope and RescaleIntercept are updated so that slope * stored + intercept keeps the value
+        given by the template rescale
+      - other modalities (NM): RescaleSlope and RescaleIntercept are not applied by the reconstruction
+        workstations, the mapping back to the simulated values is written in RealWorldValueMappingSequence
+        instead, and a warning is printed
+    - with the range of the whole volume, all files made from it share the same rescale
+    - ds is modified when the rescale changes; the conversion is applied by calling the object on frames
+    """
+    def __init__(self, ds, array, value_range=None):
+        shape, dtype = pixelShapeDtype(ds)
+        n_frames = int(ds.get("NumberOfFrames", 1) or 1)
+        if (array.ndim < 2 or tuple(array.shape[-2:]) != shape[-2:]
+                or int(np.prod(array.shape[:-2], dtype=np.int64)) != n_frames):
+            raise ValueError("The simulated images (" + " x ".join(str(item) for item in array.shape)
+                             + ") do not match the DICOM file (" + str(n_frames) + " frames x " + str(shape[-2])
+                             + " rows x " + str(shape[-1]) + " columns)")
+        self.dtype = dtype
+        bits = int(ds.get("BitsStored", ds.BitsAllocated) or ds.BitsAllocated)
+        if ds.PixelRepresentation == 1:
+            self.low, self.high = -2**(bits-1), 2**(bits-1)-1
+        else:
+            self.low, self.high = 0, 2**bits-1
+        self.scale = None
+        if np.issubdtype(array.dtype, np.integer):
+            info = np.iinfo(array.dtype)
+            if info.min >= self.low and info.max <= self.high:
+                return
+        if value_range is None:
+            value_range = valueRange(array)
+        elif callable(value_range):
+            value_range = value_range()
+        minimum, maximum, integral = value_range
+        ct = ds.get("Modality") == "CT" or ds.get("SOPClassUID") == "1.2.840.10008.5.1.4.1.1.2"
+        if (integral or not ct) and minimum >= self.low and maximum <= self.high:
+            return
+        self.minimum = minimum if np.isfinite(minimum) else 0.0
+        if maximum > minimum and not (integral and maximum-minimum <= self.high-self.low):
+            self.scale = (maximum-minimum)/(self.high-self.low)
+        else:
+            self.scale = 1.0
+        if ct:
+            slope = float(ds.get("RescaleSlope", 1) or 1)
+            intercept = float(ds.get("RescaleIntercept", 0) or 0)
+            ds.RescaleSlope = "%.8g" % (slope*self.scale)
+            ds.RescaleIntercept = "%.8g" % (intercept+slope*(self.minimum-self.scale*self.low))
+            return
+        vr = "SS" if ds.PixelRepresentation == 1 else "US"
+        mapping = pydicom.Dataset()
+        mapping[0x00409216] = pydicom.DataElement(0x00409216, vr, self.low)
+        mapping[0x00409211] = pydicom.DataElement(0x00409211, vr, self.high)
+        mapping.LUTExplanation = "Simulated counts"
+        mapping.LUTLabel = "COUNTS"
+        units = pydicom.Dataset()
+        units.CodeValue = "{counts}"
+        units.CodingSchemeDesignator = "UCUM"
+        units.CodeMeaning = "Counts"
+        mapping.MeasurementUnitsCodeSequence = [units]
+        mapping.RealWorldValueIntercept = self.minimum-self.scale*self.low
+        mapping.RealWorldValueSlope = self.scale
+        ds.RealWorldValueMappingSequence = [mapping]
+        print("Warning: simulated counts [" + "%.8g" % minimum + ", " + "%.8g" % maximum + "] do not fit " + str(bits)
+              + " bits and are mapped (RealWorldValueSlope " + "%.8g" % self.scale + ", RealWorldValueIntercept "
+              + "%.8g" % mapping.RealWorldValueIntercept + "), the stored values are not the simulated counts")
+
+    def __call__(self, array):
+        if self.scale is None:
+            if np.issubdtype(array.dtype, np.integer):
+                return np.ascontiguousarray(array, dtype=self.dtype)
+            values = np.array(array, dtype=np.float64)
+        else:
+            values = np.array(array, dtype=np.float64)
+            values -= self.minimum
+            values /= self.scale
+            values += self.low
+        np.rint(values, out=values)
+        np.nan_to_num(values, copy=False, nan=self.low)
+        np.clip(values, self.low, self.high, out=values)
+        return values.astype(self.dtype)
+#%%
+def writePixelData(dcmFile, ds, array, conversion=None):
+    """
+    Summary:
+    write a PixelData element to a DICOM file, streaming the images one frame at a time
+   
+    Parameters:
+    - dcmFile: the output file object, positioned where the element is to be written
+    - ds: the DICOM file header (for the endianess, VR and BitsAllocated)
+    - array: the images (frames x row x col or row x col), e.g. a memory-mapped view
+    - conversion: PixelConversion applied to each frame; if None, the data is only converted to the file byte order
+     
+    Remarks:
+    - no copy of the whole array is made: at most one frame is converted at a time
+    - the value is padded to an even length as required by the standard
+    """
+    endianess = "<" if ds.is_little_endian else ">"
+    if conversion is not None:
+        dtype = conversion.dtype
+    else:
+        dtype = array.dtype.newbyteorder(endianess) if array.dtype.itemsize > 1 else array.dtype
+    n_frames = array.shape[0] if array.ndim > 2 else 1
+    length = int(np.prod(array.shape))*dtype.itemsize
+    padding = length % 2
+    dcmFile.write(struct.pack(endianess+"HH", 0x7FE0, 0x0010))
+    if ds.is_implicit_VR:
+        dcmFile.write(struct.pack(endianess+"L", length+padding))
+    else:
+        vr = "OB" if ds.BitsAllocated <= 8 else "OW"
+        dcmFile.write(vr.encode("ascii")+b"\x00\x00"+struct.pack(endianess+"L", length+padding))
+    for i in range(n_frames):
+        frame = array[i] if array.ndim > 2 else array
+        frame = conversion(frame) if conversion is not None else np.ascontiguousarray(frame, dtype=dtype)
+        dcmFile.write(frame.data)
+    if padding:
+        dcmFile.write(b"\x00")
+
+#%%Compressed output
+class Compression:
+    """
+    Summary:
+    lossless compressed transfer syntax of the output DICOM files
+     
+    Parameters:
+    - syntax: "rle" (RLE Lossless) or "deflated" (Deflated Explicit VR Little Endian), see output_syntaxes
+    - jobs: number of threads compressing the frames (rle) or blocks (deflated) of a file concurrently
+    - level: zlib compression level (deflated)
+        
+    Remarks:
+    - raises ValueError if the syntax is not recognised
+    - the files are written in explicit VR little endian and their file meta TransferSyntaxUID is updated
+    - the compressed data is decoded as it is written and compared with the source images:
+      ValueError if they differ
+    - the syntaxes accepted by each workstation are in workstation_syntaxes, see checkCompression
+    - close() the thread pool when done
+    """
+    def __init__(self, syntax, jobs=1, level=6):
+        if syntax not in output_syntaxes:
+            raise ValueError("The output syntax " + str(syntax) + " is not recognised, the recognised syntaxes are: "
+                             + ", ".join(output_syntaxes))
+        self.syntax = syntax
+        self.transfer_syntax = output_syntaxes[syntax]
+        self.jobs = jobs
+        self.level = level
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def prepare(self, ds):
+        ds.file_meta.TransferSyntaxUID = self.transfer_syntax
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+
+    def map(self, function, items):
+        """function applied to items, jobs at a time, in order; at most 2 x jobs results are kept waiting"""
+        if self.jobs <= 1:
+            yield from map(function, items)
+            return
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        import collections
+        futures = collections.deque()
+        for item in items:
+            futures.append(self._executor.submit(function, item))
+            if len(futures) > 2*self.jobs:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+#%%
+def checkCompression(compression, workstation):
+    """
+    Summary:
+    check that a workstation accepts an output syntax
+   
+    Parameters:
+    - compression: "rle" or "deflated", see output_syntaxes
+    - workstation: name of the reconstruction workstation
+     
+    Remarks:
+    - prints the accepted syntaxes and returns False if not, see workstation_syntaxes
+    """
+    if compression in workstation_syntaxes.get(workstation, []):
+        return True
+    print("The output syntax " + str(compression) + " is not accepted by " + str(workstation)
+          + ". \nThe accepted syntaxes are: " + (", ".join(workstation_syntaxes.get(workstation, [])) or "none"))
+    return False
+
+#%%
+def rleEncodeFrame(ds, frame):
+    """
+    Summary:
+    encode one frame in RLE Lossless and check that it decodes to the same frame
+   
+    Parameters:
+    - ds: the DICOM file header (for the pixel type)
+    - frame: the frame (row x col), already converted to the little endian pixel type of the file
+     
+    Remarks:
+    - returns the encoded frame, padded to an even length
+    - raises ValueError if the decoded frame differs
+    - the frame is decoded with pydicom's public pixel_array, from a one-frame RLE Lossless dataset
+    """
+    from pydicom.encoders import RLELosslessEncoder
+    from pydicom.encaps import encapsulate
+    from pydicom.dataset import FileMetaDataset
+    frame = np.ascontiguousarray(frame)
+    encoded = RLELosslessEncoder.encode(frame, rows=frame.shape[0], columns=frame.shape[1], samples_per_pixel=1,
+                                        number_of_frames=1, bits_allocated=ds.BitsAllocated, bits_stored=ds.BitsStored,
+                                        pixel_representation=ds.PixelRepresentation,
+                                        photometric_interpretation=ds.PhotometricInterpretation)
+    check = pydicom.Dataset()
+    check.file_meta = FileMetaDataset()
+    check.file_meta.TransferSyntaxUID = output_syntaxes["rle"]
+    check.is_little_endian, check.is_implicit_VR = True, False
+    check.Rows, check.Columns = frame.shape
+    check.SamplesPerPixel, check.NumberOfFrames = 1, 1
+    check.BitsAllocated, check.BitsStored = ds.BitsAllocated, ds.BitsStored
+    check.HighBit, check.PixelRepresentation = ds.BitsStored-1, ds.PixelRepresentation
+    check.PhotometricInterpretation = ds.PhotometricInterpretation
+    check.PixelData = encapsulate([encoded])
+    if not np.array_equal(check.pixel_array, frame):
+        raise ValueError("RLE round trip differs from the source frame")
+    if len(encoded) % 2:
+        encoded += b"\x00"
+    return encoded
+
+#%%
+def writeEncapsulatedPixelData(dcmFile, ds, array, conversion, compression):
+    """
+    Summary:
+    write an RLE Lossless encapsulated PixelData element to a DICOM file, one fragment per frame
+   
+    Parameters:
+    - dcmFile: the output file object (seekable), positioned where the element is to be written
+    - ds: the DICOM file header, explicit VR little endian (see Compression.prepare)
+    - array: the images (frames x row x col or row x col)
+    - conversion: PixelConversion applied to each frame
+    - compression: Compression encoding the frames concurrently
+     
+    Remarks:
+    - the basic offset table is written empty and filled once all frames are written
+    """
+    n_frames = array.shape[0] if array.ndim > 2 else 1
+    frames = (array[i] if array.ndim > 2 else array for i in range(n_frames))
+    dcmFile.write(struct.pack("<HH", 0x7FE0, 0x0010) + b"OB\x00\x00" + struct.pack("<L", 0xFFFFFFFF))
+    dcmFile.write(struct.pack("<HHL", 0xFFFE, 0xE000, 4*n_frames))
+    table = dcmFile.tell()
+    dcmFile.write(bytes(4*n_frames))
+    offsets = []
+    start = dcmFile.tell()
+    for encoded in compression.map(lambda frame: rleEncodeFrame(ds, conversion(frame)), frames):
+        offsets.append(dcmFile.tell()-start)
+        dcmFile.write(struct.pack("<HHL", 0xFFFE, 0xE000, len(encoded)))
+        dcmFile.write(encoded)
+    dcmFile.write(struct.pack("<HHL", 0xFFFE, 0xE0DD, 0))
+    end = dcmFile.tell()
+    dcmFile.seek(table)
+    dcmFile.write(struct.pack("<%dL" % n_frames, *offsets))
+    dcmFile.seek(end)
+
+#%%
+class DeflatedFile:
+    """
+    Summary:
+    file object deflating what is written to it, for Deflated Explicit VR Little Endian
+     
+    Parameters:
+    - dcmFile: the output file object, positioned after the file meta information
+    - compression: Compression deflating blocks of the data concurrently
+    - block_size: size of the blocks deflated independently
+        
+    Remarks:
+    - the blocks are deflated separately and concatenated into one deflate stream (ended by close())
+    - the stream written is inflated again and compared with the data (SHA-1): ValueError if they differ
+    """
+    def __init__(self, dcmFile, compression, block_size=1 << 20):
+        self.dcmFile = dcmFile
+        self.compression = compression
+        self.block_size = block_size
+        self.blocks = []
+        self.buffer = bytearray()
+        self.position = 0
+        self.length = 0
+        self.digest = hashlib.sha1()
+        self.inflated_digest = hashlib.sha1()
+        import zlib
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.digest.update(data)
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.block_size:
+            self.blocks.append(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        if len(self.blocks) >= 2*max(self.compression.jobs, 1):
+            self._flush()
+
+    def _deflate(self, block):
+        import zlib
+        data, final = block
+        compressor = zlib.compressobj(self.compression.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+    def _flush(self, final=False):
+        blocks = [(block, False) for block in self.blocks]
+        if final:
+            blocks.append((bytes(self.buffer), True))
+            self.buffer = bytearray()
+        self.blocks = []
+        for deflated in self.compression.map(self._deflate, blocks):
+            self.dcmFile.write(deflated)
+            self.length += len(deflated)
+            self.inflated_digest.update(self.inflater.decompress(deflated))
+
+    def close(self):
+        self._flush(final=True)
+        self.inflated_digest.update(self.inflater.flush())
+        if len(self.inflater.unused_data) or self.inflated_digest.digest() != self.digest.digest():
+            raise ValueError("Deflated data differs from the source data")
+        if self.length % 2:
+            self.dcmFile.write(b"\x00")
+
+#%%
+def writeDICOM(ds, array, output_file_name, value_range=None, compression=None, sender=None):
+    """
+    Summary:
+    save a DICOM file with new images without building its pixel data in memory
+   
+    Parameters:
+    - ds: the DICOM file header, typically read with readTemplate; its PixelData is replaced by array
+    - array: the new images (frames x row x col or row x col), e.g. a memory-mapped view
+    - output_file_name: path to the DICOM file to be written
+    - value_range: value range of the whole simulated volume array is taken from (or a function returning it),
+      see PixelConversion
+    - compression: Compression of the file, the transfer syntax of the template is kept if None
+    - sender: DicomSender the file is also sent with, once written
+     
+    Remarks:
+    - the header is written by pydicom, then array is converted to the pixel type of ds and streamed
+      frame by frame (see writePixelData), then any element following PixelData
+    - ds is modified: PixelData and the elements following it are removed
+    - the file is written under a temporary name (see partFileName) and renamed when complete,
+      so an interrupted run never leaves a truncated output_file_name
+    - with sender, the name of the file is handed to sender once the file is complete
+    """
+    trailing = pydicom.Dataset()
+    for tag in [tag for tag in ds.keys() if tag >= 0x7FE00010]:
+        if tag > 0x7FE00010:
+            trailing[tag] = ds[tag]
+        del ds[tag]
+    if compression is not None:
+        compression.prepare(ds)
+    with profileStage("convert", output_file_name):
+        conversion = PixelConversion(ds, array, value_range)
+    from pydicom.filebase import DicomFileLike
+    from pydicom.filewriter import write_dataset, write_file_meta_info
+    part_file_name = partFileName(output_file_name)
+    try:
+        with profileStage("save", output_file_name) as record, open(part_file_name, "wb") as outputFile:
+            dcmFile = outputFile
+            if compression is not None and compression.syntax == "deflated":
+                dcmFile.write((ds.preamble or bytes(128)) + b"DICM")
+                write_file_meta_info(DicomFileLike(dcmFile), ds.file_meta, enforce_standard=False)
+                dataFile = DeflatedFile(dcmFile, compression)
+                headerFile = DicomFileLike(dataFile)
+                headerFile.is_little_endian = True
+                headerFile.is_implicit_VR = False
+                write_dataset(headerFile, ds)
+            else:
+                dataFile = dcmFile
+                ds.save_as(dcmFile)
+            if compression is not None and compression.syntax == "rle":
+                writeEncapsulatedPixelData(dcmFile, ds, array, conversion, compression)
+            else:
+                writePixelData(dataFile, ds, array, conversion)
+            if len(trailing):
+                trailingFile = DicomFileLike(dataFile)
+                trailingFile.is_little_endian = ds.is_little_endian
+                trailingFile.is_implicit_VR = ds.is_implicit_VR
+                write_dataset(trailingFile, trailing)
+            if dataFile is not dcmFile:
+                dataFile.close()
+            record["bytes_written"]=outputFile.tell()
+        os.replace(part_file_name, output_file_name)
+        if sender is not None:
+            sender.submit(output_file_name)
+    except BaseException:
+        if os.path.exists(part_file_name):
+            os.remove(part_file_name)
+        raise
+#%%
+def partFileName(output_file_name):
+    """
+    Summary:
+    temporary name under which an output file is written before being renamed
+   
+    Parameters:
+    - output_file_name: path to the final file
+     
+    Remarks:
+    - hidden file (.name.part) in the same folder, so the final rename is atomic
+    """
+    folder, name = os.path.split(str(output_file_name))
+    return os.path.join(folder, "." + name + ".part")
+
+#%%image_to_array
+def image_to_array(images, mmap=False):
+    """
+    Summary:
+    convert images (hdr,mhd or dcm) file into a numpy array
+     
+    Parameters:
+    - images: the name of the image file
+    - mmap: if True, the image data is memory-mapped and a lazy read-only view is returned
+        
+    Remarks:
+    - with mmap, the data is read when used: no bytes read are recorded by the profiler
+    """
+    with profileStage("image_to_array", images) as record:
+        if images.lower().endswith("dcm") or images.lower().endswith("ima"):
+            if mmap:
+                array=readRawDCMData(images)
+            else:
+                ds = pydicom.read_file(images)
+                array= ds.pixel_array
+        elif images.lower().endswith("hdr"):
+            array=readRawHDRData(images, mmap)
+        elif images.lower().endswith("mhd"):
+            array=readRawMHDData(images, mmap)
+        if not mmap:
+            record["bytes_read"]=array.nbytes
+    return array
+#%%VolumeSource
+class VolumeSource:
+    """
+    Summary:
+    simulated volume (hdr, mhd or dcm) read once and handed out as per-slice or per-frame views
+     
+    Parameters:
+    - file_name: the name of the image file
+    - mmap: if True, the image data is memory-mapped so only the slices or frames used are read
+        
+    Remarks:
+    - the file is only read on first access; every later call returns a view of the same array
+    - valueRange() is computed once for the whole volume, so that every file made from it gets the same rescale
+    - slices and frames are taken along the first axis (n_images x row x col)
+    - safe to share between the threads of runJobs
+    """
+    def __init__(self, file_name, mmap=False):
+        self.file_name = file_name
+        self.mmap = mmap
+        self._array = None
+        self._range = None
+        self._lock = threading.Lock()
+        self._range_lock = threading.Lock()
+
+    @property
+    def array(self):
+        with self._lock:
+            if self._array is None:
+                self._array = image_to_array(self.file_name, self.mmap)
+        return self._array
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def slice(self, index):
+        return self.array[index,:,:]
+
+    def frames(self, start, stop):
+        return self.array[start:stop,:,:]
+
+    def valueRange(self):
+        array = self.array
+        with self._range_lock:
+            if self._range is None:
+                with profileStage("value_range", self.file_name):
+                    self._range = valueRange(array)
+        return self._range
+#%%Frame assembly
+def frameOrder(ds):
+    """
+    Summary:
+    position in the DICOM file of each frame of a multi-frame NM file, frames being taken window by window,
+    then detector by detector
+     
+    Parameters:
+    - ds: a SPECT DICOM file header
+        
+    Remarks:
+    - based on EnergyWindowVector (0054,0010) and DetectorVector (0054,0020), frames are kept in file order
+      within a (window, detector) pair; a missing vector or a vector of the wrong length counts as all 1
+    - returns None if the frames are already in that order (the usual case)
+    """
+    n_frames = int(ds.get("NumberOfFrames", 1) or 1)
+    vectors = []
+    for tag in [0x00540020, 0x00540010]:
+        vector = ds[tag].value if tag in ds else None
+        if vector is None or isinstance(vector, (int, float)) or len(vector) != n_frames:
+            vector = np.ones(n_frames, dtype=int)
+        vectors.append(np.asarray(vector, dtype=int))
+    order = np.lexsort([np.arange(n_frames)]+vectors)
+    if np.array_equal(order, np.arange(n_frames)):
+        return None
+    return order
+#%%
+def assembleFrames(ds, sources, start=0):
+    """
+    Summary:
+    build the images of a SPECT DICOM file from the frames of one or more simulated volumes
+     
+    Parameters:
+    - ds: the SPECT DICOM file header, giving the number of frames and their layout
+    - sources: list of VolumeSource whose frames, taken one source after the other, are window by window,
+      then detector by detector (e.g. one source per energy window, or per window and detector)
+    - start: index of the first frame used among all frames of sources (e.g. the frames of the files before)
+        
+    Remarks:
+    - if all frames come from one source and are in file order, a view of the source is returned (no copy,
+      memory-mapped sources stay on disk)
+    - otherwise the images are written once into a preallocated array of the type of the simulated images
+      (converted to the type of the DICOM file later, see PixelConversion): one slice or one indexed assignment
+      per source, no per-frame work
+    - raises ValueError if sources do not have enough frames
+    """
+    shape = pixelShapeDtype(ds)[0]
+    n_frames = int(ds.get("NumberOfFrames", 1) or 1)
+    order = frameOrder(ds)
+    pieces = []
+    position = 0
+    for source in sources:
+        first, last = max(start-position, 0), min(start+n_frames-position, len(source))
+        if first < last:
+            pieces.append((source, first, last, position+first-start))
+        position += len(source)
+        if position >= start+n_frames:
+            break
+    if sum(last-first for source, first, last, destination in pieces) != n_frames:
+        raise ValueError("The simulated images have " + str(position) + " frames, frames " + str(start) + " to "
+                         + str(start+n_frames) + " are needed for " + str(ds.get("SeriesDescription", "the SPECT file")))
+    if len(pieces) == 1 and order is None:
+        source, first, last, destination = pieces[0]
+        return source.frames(first, last).reshape(shape)
+    dtype = np.result_type(*[source.array.dtype for source, first, last, destination in pieces])
+    array = np.empty(shape=(n_frames,)+shape[-2:], dtype=dtype)
+    for source, first, last, destination in pieces:
+        if order is None:
+            array[destination:destination+last-first] = source.frames(first, last)
+        else:
+            array[order[destination:destination+last-first]] = source.frames(first, last)
+    return array.reshape(shape)
+#%%
+def listSimImages(sim_input_folder):
+    """
+    
+    Summary:
+    list the simulated images of a folder in natural order
+    
+    Parameters:
+    - sim_input_folder: path to the folder containing the simulated images (dcm (or IMA) or hdr or mhd)
+   
+    Remarks:
+    - the full paths of the image files are returned
+      
+    """
+    with profileStage("list", sim_input_folder):
+        list_sim_trans=os.listdir(sim_input_folder)
+    list_sim=[]
+    image_extension=["dcm","ima","mhd","hdr"]
+    for item in image_extension:
+        sim=[file for file in list_sim_trans if file.lower().endswith(item)]
+        list_sim.extend(sim)
+    with profileStage("natsort", sim_input_folder):
+        list_sim=natsort.natsorted(list_sim)
+    return [os.path.join(sim_input_folder, file) for file in list_sim]
+#%%Template index
+index_tags=[0x00080018, 0x00200013, 0x00200032, 0x00200037, 0x00280008, 0x00280010, 0x00280011, 0x00280100,
+            0x00280103]
+
+def indexCacheFolder():
+    """
+    
+    Summary:
+    folder of the template index cache
+    
+    Parameters:
+    -
+   
+    Remarks:
+    - the DICOM_MODIFY_CACHE environment variable, ~/.cache/DICOM_modify by default
+    - None (no cache on disk) if DICOM_MODIFY_CACHE is set to an empty string
+      
+    """
+    folder=os.environ.get("DICOM_MODIFY_CACHE")
+    if folder is None:
+        folder=os.path.join(os.path.expanduser("~"), ".cache", "DICOM_modify")
+    return folder or None
+#%%
+def readIndexEntry(file_name):
+    """
+    
+    Summary:
+    read the fields of the template index from the header of a DICOM file
+    
+    Parameters:
+    - file_name: path to the DICOM file
+   
+    Remarks:
+    - only the tags of index_tags are read (no pixel data)
+    - a file that cannot be read gets an "error" field instead, and fails when processed
+      
+    """
+    try:
+        ds=pydicom.read_file(file_name, stop_before_pixels=True, specific_tags=index_tags)
+    except Exception as error:
+        return {"error": repr(error)}
+    position=ds.get("ImagePositionPatient")
+    orientation=ds.get("ImageOrientationPatient")
+    instance=ds.get("InstanceNumber")
+    return {"SOPInstanceUID": str(ds.get("SOPInstanceUID", "")),
+            "InstanceNumber": int(instance) if instance not in (None, "") else None,
+            "ImagePositionPatient": [float(item) for item in position] if position else None,
+            "ImageOrientationPatient": [float(item) for item in orientation] if orientation else None,
+            "NumberOfFrames": int(ds.get("NumberOfFrames", 1) or 1),
+            "Rows": int(ds.get("Rows", 0) or 0), "Columns": int(ds.get("Columns", 0) or 0),
+            "BitsAllocated": int(ds.get("BitsAllocated", 0) or 0),
+            "PixelRepresentation": int(ds.get("PixelRepresentation", 0) or 0),
+            "TransferSyntaxUID": str(ds.file_meta.get("TransferSyntaxUID", "")) if hasattr(ds, "file_meta") else ""}
+#%%
+def slicePosition(entry):
+    """
+    
+    Summary:
+    position of a slice along the normal to its plane
+    
+    Parameters:
+    - entry: an entry of the template index
+   
+    Remarks:
+    - None if ImagePositionPatient or ImageOrientationPatient is missing
+      
+    """
+    position, orientation=entry.get("ImagePositionPatient"), entry.get("ImageOrientationPatient")
+    if not position or not orientation or len(position) != 3 or len(orientation) != 6:
+        return None
+    row, column=orientation[:3], orientation[3:]
+    normal=[row[1]*column[2]-row[2]*column[1], row[2]*column[0]-row[0]*column[2], row[0]*column[1]-row[1]*column[0]]
+    return sum(item*direction for item, direction in zip(position, normal))
+#%%
+def templateIndex(input_folder):
+    """
+    
+    Summary:
+    list the DICOM files of a folder in slice order, from their headers only
+    
+    Parameters:
+    - input_folder: path to the folder containing the DICOM files
+   
+    Remarks:
+    - returns a list of dicts: file (full path), name, size, mtime_ns and the fields of readIndexEntry
+    - order: position along the slice normal (increasing, as ITK), then InstanceNumber, then file name
+      (natural order); files without position come after those with one
+    - cached on disk (see indexCacheFolder): only new or modified files (size or modification time) are read
+      again, so repeated runs on the same templates do not read their headers
+      
+    """
+    folder=os.path.abspath(str(input_folder))
+    cache_folder=indexCacheFolder()
+    cache_file=None
+    cached={}
+    if cache_folder:
+        cache_file=os.path.join(cache_folder, hashlib.sha1(folder.encode("utf-8")).hexdigest()[:20]+".json")
+        try:
+            with open(cache_file, "r") as cacheFile:
+                cache=json.load(cacheFile)
+            if cache.get("folder") == folder and cache.get("tags") == index_tags:
+                cached=cache["files"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            cached={}
+    entries={}
+    changed=False
+    with profileStage("index", folder) as record:
+        with os.scandir(folder) as items:
+            for item in items:
+                if not item.is_file():
+                    continue
+                stat=item.stat()
+                entry=cached.get(item.name)
+                if entry is None or entry.get("size") != stat.st_size or entry.get("mtime_ns") != stat.st_mtime_ns:
+                    entry=readIndexEntry(item.path)
+                    entry.update({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+                    record["bytes_read"]=record.get("bytes_read", 0)+stat.st_size
+                    changed=True
+                entries[item.name]=entry
+    if cache_file and (changed or len(entries) != len(cached)):
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", dir=cache_folder, suffix=".part", delete=False) as cacheFile:
+                json.dump({"folder": folder, "tags": index_tags, "files": entries}, cacheFile)
+            os.replace(cacheFile.name, cache_file)
+        except OSError:
+            pass
+    index=[dict(entry, name=name, file=os.path.join(folder, name)) for name, entry in entries.items()]
+    index=natsort.natsorted(index, key=lambda entry: entry["name"])
+    def sliceOrder(entry):
+        position=slicePosition(entry)
+        instance=entry.get("InstanceNumber")
+        return (position is None, position or 0.0, instance is None, instance or 0)
+    return sorted(index, key=sliceOrder)
+#%%
+def renewUIDs(ds):
+    """
+    
+    Summary:
+    modify the SOP instance, study and series UIDs to prevent the original files from being overwritten
+    
+    Parameters:
+    - ds: a DICOM file
+   
+    Remarks:
+    - 10000 is added to the last element of each UID
+      
+    """
+    val=ds[0x00080018].value
+    val=lastReplace(val, 10000)
+    changeTagValue(ds,0x00080018,val)
+    val=ds[0x0020000d].value
+    val=lastReplace(val, 10000)
+    changeTagValue(ds,0x0020000d,val)
+    val=ds[0x0020000e].value
+    val=lastReplace(val, 10000)
+    changeTagValue(ds,0x0020000e,val)
+#%%Tag rules
+def emissionMask(ds):
+    """
+    
+    Summary:
+    frames of the emission windows of a SPECT header
+    
+    Parameters:
+    - ds: the SPECT header
+   
+    Remarks:
+    - a frame is kept if its EnergyWindowVector (0054,0010) value is n_emission_w or less, so that the
+      frames of interleaved windows are selected too
+    - without a per-frame EnergyWindowVector, frames are taken window by window (the first ones are kept)
+    - returns a boolean array with one value per frame
+    """
+    n_frames=int(ds.get("NumberOfFrames", 1) or 1)
+    vector=np.atleast_1d(np.asarray(ds.get("EnergyWindowVector", []), dtype=int))
+    if len(vector) == n_frames:
+        return vector <= n_emission_w
+    n_energy_w=int(ds.get("NumberOfEnergyWindows", 1) or 1)
+    return np.arange(n_frames) < int(n_frames*n_emission_w/n_energy_w)
+
+def emissionFrames(value, context):
+    if isinstance(value, (str, bytes)) or not hasattr(value, "__len__"):
+        return value
+    return [item for item, keep in zip(value, context["emission_mask"]) if keep]
+
+tag_transforms={
+    "set": lambda value, rule, context: rule["value"],
+    "uid": lambda value, rule, context: lastReplace(value, 10000),
+    #number of frames of the emission windows
+    "emission_count": lambda value, rule, context: int(np.count_nonzero(context["emission_mask"])),
+    #per-frame values of the emission windows (frames selected by emissionMask)
+    "emission_frames": lambda value, rule, context: emissionFrames(value, context),
+    #per-window values of the emission windows
+    "emission_windows": lambda value, rule, context: value[0:context["n_emission_w"]],
+    "n_emission_windows": lambda value, rule, context: context["n_emission_w"],
+}
+#%%
+class TagPlan:
+    """
+    Summary:
+    tag rules of one SPECTCT model and reconstruction workstation, ready to be applied to every file
+     
+    Parameters:
+    - steps: list of (path, transform, rule), see compileTagPlan
+        
+    Remarks:
+    - apply(ds) modifies ds and returns the context of the transforms (frames of the emission windows...),
+      read from ds before any tag is modified
+    - rules that transform the current value are skipped if the tag is absent; "set" rules create it,
+      with the VR of the rule or of the DICOM dictionary, and print a message the first time only
+    """
+    def __init__(self, steps):
+        self.steps = steps
+        self.created = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.steps)
+
+    def apply(self, ds):
+        context = {"emission_mask": emissionMask(ds), "n_emission_w": n_emission_w}
+        for path, transform, rule in self.steps:
+            unless = rule.get("unless")
+            if unless is not None and unless[0] in ds and unless[1] in str(ds[unless[0]].value):
+                continue
+            parent = tagParent(ds, path)
+            if parent is None:
+                continue
+            if path[-1] in parent:
+                element = parent[path[-1]]
+                element.value = transform(element.value, rule, context)
+            elif rule["transform"] == "set":
+                vr = rule.get("VR")
+                if vr is None:
+                    from pydicom.datadict import dictionary_VR
+                    vr = dictionary_VR(path[-1])
+                parent.add_new(path[-1], vr, transform(None, rule, context))
+                with self._lock:
+                    if path not in self.created:
+                        self.created.add(path)
+                        print("Tag " + " > ".join("(%04X,%04X)" % (tag >> 16, tag & 0xFFFF) for tag in path) + " created")
+        return context
+#%%
+@functools.lru_cache(maxsize=None)
+def compileTagPlan(model, workstation):
+    """
+    
+    Summary:
+    select the rules of spect_tag_rules for a SPECTCT model and reconstruction workstation
+    
+    Parameters:
+    - model: name of the SPECTCT model, to be chosen among list_models
+    - workstation: name of the reconstruction workstation, to be chosen among list_stations
+   
+    Remarks:
+    - compiled once per model and workstation, the TagPlan is then shared by all files
+    - raises KeyError if a rule has an unknown transform
+      
+    """
+    steps=[]
+    for rule in spect_tag_rules:
+        if model in rule.get("models", [model]) and workstation in rule.get("workstations", [workstation]):
+            path=tuple(rule["tag"]) if isinstance(rule["tag"], list) else (rule["tag"],)
+            steps.append((path, tag_transforms[rule["transform"]], rule))
+    return TagPlan(steps)
+#%%
+def runJobs(function, tasks, jobs=1, executor=None):
+    """
+    
+    Summary:
+    run a function on a list of tasks, one after the other or concurrently in a thread pool
+    
+    Parameters:
+    - function: the function to be run
+    - tasks: list of (name, arguments) pairs, name identifying the task (e.g. the file name) in error messages
+    - jobs: number of tasks run concurrently
+    - executor: thread pool to be used instead of creating one (e.g. shared between the cases of a batch)
+   
+    Remarks:
+    - a failing task does not stop the others; failures are printed and returned as a list of (name, exception)
+    - tasks must not depend on the working directory (absolute paths only)
+      
+    """
+    failures=[]
+    if executor is not None and jobs > 1:
+        futures=[(name, executor.submit(function, *arguments)) for name, arguments in tasks]
+        for name, future in futures:
+            if future.exception() is not None:
+                failures.append((name, future.exception()))
+    elif jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return runJobs(function, tasks, jobs, executor)
+    else:
+        for name, arguments in tasks:
+            try:
+                function(*arguments)
+            except Exception as error:
+                failures.append((name, error))
+    for name, error in failures:
+        print("Failed to process " + str(name) + ": " + repr(error))
+    return failures
+#%%Incremental runs
+def simDataFiles(sim_file_name):
+    """
+    
+    Summary:
+    list the files holding a simulated image: the image file and, for hdr and mhd, the raw data file(s)
+    
+    Parameters:
+    - sim_file_name: path to the simulated image (dcm (or IMA) or hdr or mhd)
+   
+    Remarks:
+    -
+      
+    """
+    sim_file_name=str(sim_file_name)
+    if sim_file_name.lower().endswith("hdr"):
+        dataFileName=readHDR(sim_file_name)[1]
+    elif sim_file_name.lower().endswith("mhd"):
+        dataFileName=readMHD(sim_file_name)[1]
+    else:
+        return [sim_file_name]
+    if not isinstance(dataFileName, list):
+        dataFileName=[dataFileName]
+    return [sim_file_name]+[item for item in dataFileName if item != sim_file_name]
+#%%
+def inputSignature(file_names, parameters):
+    """
+    
+    Summary:
+    signature of the inputs of an output file
+    
+    Parameters:
+    - file_names: the files the output is made from (template and simulated images)
+    - parameters: any other value the output depends on (index, model, workstation...), json serialisable
+   
+    Remarks:
+    - based on the path, size and modification time of the files, not on their content
+      
+    """
+    items=[]
+    for file_name in file_names:
+        stat=os.stat(file_name)
+        items.append([os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps([items, parameters]).encode()).hexdigest()
+#%%
+class RunManifest:
+    """
+    Summary:
+    journal of the output files of a folder and of the signature of the inputs they were made from
+     
+    Parameters:
+    - output_folder: the folder of the output files, where the journal is kept
+        
+    Remarks:
+    - one json line per output file, appended and flushed as soon as the file is written,
+      so the outputs of an interrupted run are known to the next one
+    - an output is up to date if its signature is unchanged and the file has the recorded size
+    - rewritten with the latest line of each output by close()
+    - safe to share between the threads of runJobs
+    """
+    file_name = ".DICOM_modify_manifest.jsonl"
+
+    def __init__(self, output_folder):
+        self.path = os.path.join(str(output_folder), self.file_name)
+        self.entries = {}
+        self._journal = None
+        self._lock = threading.Lock()
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as manifestFile:
+                for line in manifestFile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        #last line of an interrupted run
+                        continue
+                    self.entries[entry["output"]] = entry
+
+    def isUpToDate(self, output_file_name, signature):
+        entry = self.entries.get(os.path.basename(str(output_file_name)))
+        return (entry is not None and entry["signature"] == signature and os.path.isfile(output_file_name)
+                and os.path.getsize(output_file_name) == entry["size"])
+
+    def record(self, output_file_name, signature):
+        entry = {"output": os.path.basename(str(output_file_name)), "signature": signature,
+                 "size": os.path.getsize(output_file_name)}
+        with self._lock:
+            self.entries[entry["output"]] = entry
+            if self._journal is None:
+                self._rewrite()
+                self._journal = open(self.path, "a")
+            self._journal.write(json.dumps(entry) + "\n")
+            self._journal.flush()
+
+    def _rewrite(self):
+        part_file_name = partFileName(self.path)
+        with open(part_file_name, "w") as manifestFile:
+            for entry in self.entries.values():
+                manifestFile.write(json.dumps(entry) + "\n")
+        os.replace(part_file_name, self.path)
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+                self._rewrite()
+#%%
+def skipUpToDate(tasks, inputs, manifest):
+    """
+    
+    Summary:
+    drop the tasks whose output file is up to date
+    
+    Parameters:
+    - tasks: list of file tasks, see runFileTasks
+    - inputs: for each task, the (file_names, parameters) its output is made from, see inputSignature
+    - manifest: RunManifest of the output folder
+   
+    Remarks:
+    - returns the remaining tasks, with the signature to be recorded in the manifest once written
+      
+    """
+    remaining=[]
+    for task, (file_names, parameters) in zip(tasks, inputs):
+        signature=inputSignature(file_names, parameters)
+        if not manifest.isUpToDate(task["output"], signature):
+            remaining.append(dict(task, signature=signature))
+    if len(remaining) < len(tasks):
+        print(str(len(tasks)-len(remaining)) + " files already up to date in " + str(os.path.dirname(manifest.path)))
+    return remaining
+#%%
+def runFileTasks(tasks, jobs=1, executor=None, manifest=None, pipeline=None):
+    """
+    
+    Summary:
+    create the output files of a list of file tasks
+    
+    Parameters:
+    - tasks: list of dicts, one per output file:
+      name: the name of the task in error messages, output: the output file name, compression: its Compression, sender: its DicomSender,
+      modify: (function, arguments) creating the file in one go,
+      read: (function, arguments) returning (ds, array, value_range), tags: (function, arguments) called as
+      function(ds, array, *arguments) and returning the array, for the stages of a Pipeline
+    - jobs: number of tasks run concurrently, see runJobs
+    - executor: thread pool to be used instead of creating one, see runJobs
+    - manifest: RunManifest in which the written files are recorded (tasks with a signature, see skipUpToDate)
+    - pipeline: Pipeline running the read, tags and write stages overlapped, instead of runJobs
+   
+    Remarks:
+    - returns the list of (name, exception) for the tasks that failed
+      
+    """
+    def written(task):
+        if manifest is not None and "signature" in task:
+            manifest.record(task["output"], task["signature"])
+    if pipeline is not None:
+        return pipeline.run(tasks, written)
+    def modify(task):
+        function, arguments=task["modify"]
+        function(*arguments)
+        written(task)
+    return runJobs(modify, [(task["name"], (task,)) for task in tasks], jobs, executor)
+#%%Pipeline
+class Pipeline:
+    """
+    Summary:
+    run file tasks in overlapped stages: read (templates and simulated images), transform (tags and
+    conversion of the images) and write, connected by bounded queues
+     
+    Parameters:
+    - depth: maximum number of files between their read and their write, so at most depth files are in memory
+    - readers: number of threads reading (prefetching) templates and simulated images
+    - workers: number of threads modifying tags and converting images
+    - ordered: if True, the files are written in the order of the tasks, otherwise as soon as they are ready
+        
+    Remarks:
+    - one background thread writes the files, so reads, computation and writes of different files overlap;
+      useful when the inputs or the outputs are on a network share
+    - memory-mapped simulated images are read in the read stage, and the images are converted to the pixel
+      type of the DICOM file (see PixelConversion) frame by frame in the transform stage, so a file in flight
+      takes the size of its output images
+    - run(tasks, written) returns the list of (name, exception) for the tasks that failed, as runJobs;
+      written(task) is called once a file is written
+    - tasks: see runFileTasks
+    """
+    def __init__(self, depth=4, readers=2, workers=1, ordered=True):
+        self.depth = max(int(depth), 1)
+        self.readers = max(int(readers), 1)
+        self.workers = max(int(workers), 1)
+        self.ordered = ordered
+
+    def run(self, tasks, written=None):
+        import queue
+        tasks = list(tasks)
+        slots = threading.Semaphore(self.depth)
+        transform_queue = queue.Queue()
+        write_queue = queue.Queue()
+        next_task = iter(range(len(tasks)))
+        next_lock = threading.Lock()
+        failures = []
+
+        def read():
+            while True:
+                #a slot is taken before the next task, so the task waited for by the writer always has one
+                slots.acquire()
+                with next_lock:
+                    number = next(next_task, None)
+                if number is None:
+                    slots.release()
+                    return
+                task = tasks[number]
+                try:
+                    function, arguments = task["read"]
+                    ds, array, value_range = function(*arguments)
+                    if isinstance(array, np.memmap) or not isinstance(array, np.ndarray):
+                        array = np.array(array)
+                    transform_queue.put((number, (ds, array, value_range), None))
+                except Exception as error:
+                    transform_queue.put((number, None, error))
+
+        def transform():
+            while True:
+                item = transform_queue.get()
+                if item is None:
+                    return
+                number, data, error = item
+                if error is None:
+                    try:
+                        ds, array, value_range = data
+                        function, arguments = tasks[number]["tags"]
+                        array = function(ds, array, *arguments)
+                        with profileStage("convert", tasks[number]["output"]):
+                            conversion = PixelConversion(ds, array, value_range)
+                            #frame by frame, so that only one frame is converted to float at a time
+                            converted = np.empty(array.shape, dtype=conversion.dtype)
+                            frames = converted.reshape((-1,)+array.shape[-2:])
+                            for frame, source in zip(frames, array.reshape((-1,)+array.shape[-2:])):
+                                frame[...] = conversion(source)
+                            array = converted
+                        data = (ds, array, (conversion.low, conversion.high, True))
+                    except Exception as error_transform:
+                        data, error = None, error_transform
+                write_queue.put((number, data, error))
+
+        def write(number, data, error):
+            task = tasks[number]
+            if error is None:
+                try:
+                    ds, array, value_range = data
+                    writeDICOM(ds, array, task["output"], value_range, task.get("compression"), task.get("sender"))
+                    if written is not None:
+                        written(task)
+                except Exception as error_write:
+                    error = error_write
+            if error is not None:
+                failures.append((task["name"], error))
+            slots.release()
+
+        def writer():
+            pending = {}
+            expected = 0
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    return
+                if not self.ordered:
+                    write(*item)
+                    continue
+                pending[item[0]] = item
+                while expected in pending:
+                    write(*pending.pop(expected))
+                    expected += 1
+
+        readers = [threading.Thread(target=read) for i in range(self.readers)]
+        workers = [threading.Thread(target=transform) for i in range(self.workers)]
+        writer_thread = threading.Thread(target=writer)
+        for thread in readers+workers+[writer_thread]:
+            thread.start()
+        for thread in readers:
+            thread.join()
+        for thread in workers:
+            transform_queue.put(None)
+        for thread in workers:
+            thread.join()
+        write_queue.put(None)
+        writer_thread.join()
+        for name, error in failures:
+            print("Failed to process " + str(name) + ": " + repr(error))
+        return failures
+#%% 
+def ctReadFile(file_name, sim_file_name, volume=None, index=0, mmap=False):
+    """
+    
+    Summary:
+    read a CT template and its simulated image
+    
+    Parameters:
+    - see ctModifyFile
+   
+    Remarks:
+    - returns the template header, the simulated image and the value range of the simulated volume
+      (see PixelConversion)
+    - raises ValueError if there is no simulated image for the template (sim_file_name and volume None)
+      
+    """
+    if volume is None and sim_file_name is None:
+        raise ValueError("No simulated image for " + os.path.basename(file_name)
+                         + ", there are fewer simulated files than CT files")
+    ds=readTemplate(file_name)
+    if volume is not None:
+        array = volume.slice(index)
+        value_range = volume.valueRange
+    else:
+        array=image_to_array(sim_file_name, mmap)
+        value_range = None
+    return ds, array, value_range
+#%% 
+def ctModifyTags(ds, array):
+    """
+    
+    Summary:
+    modify the tags of a CT template
+    
+    Parameters:
+    - ds: the CT template header
+    - array: its simulated image
+   
+    Remarks:
+    - returns the simulated image
+      
+    """
+    with profileStage("tags", ds.filename):
+        renewUIDs(ds)
+    return array
+#%% 
+def ctModifyFile(file_name, output_file_name, sim_file_name, volume=None, index=0, mmap=False, compression=None,
+                 sender=None):
+    """
+    
+    Summary:
+    create one new CT DICOM file with a new image
+    
+    Parameters:
+    - file_name: path to the original CT DICOM file
+    - output_file_name: path to the modified CT DICOM file
+    - sim_file_name: path to the simulated image, if one file for each image
+    - volume: VolumeSource of the simulated images, if one file containing all images
+    - index: index of the slice in volume
+    - mmap: if True, the simulated image is memory-mapped instead of read into memory
+    - compression: Compression of the output file, the transfer syntax of the template is kept if None
+    - sender: DicomSender the output file is also sent with
+   
+    Remarks:
+    - ctReadFile, then ctModifyTags, then writeDICOM
+      
+    """
+    ds, array, value_range=ctReadFile(file_name, sim_file_name, volume, index, mmap)
+    array=ctModifyTags(ds, array)
+    writeDICOM(ds, array, output_file_name, value_range, compression, sender)
+#%% 
+def ctAddSim(input_folder, sim_input_folder, output_folder, mmap=False, jobs=1, executor=None, incremental=False,
+             pipeline=None, compression=None, sender=None):
+    """
+    
+    Summary:
+    create new CT DICOM files with new images
+    
+    Parameters:
+    - input_folder: path to the folder containing the original CT DICOM files
+    - sim_input_folder: path to the folder containing the simulated images (dcm (or IMA) or hdr or mhd)
+    - output_folder: path to the folder where the modified CT DICOM files are to be saved
+    - mmap: if True, the simulated images are memory-mapped instead of read into memory
+    - jobs: number of files processed concurrently
+    - executor: thread pool to be used instead of creating one, see runJobs
+    - incremental: if True, the files already up to date in output_folder are not written again, see RunManifest
+    - pipeline: Pipeline overlapping the reads, the tag modifications and the writes of the files, instead of jobs
+    - compression: Compression of the output files, the transfer syntax of the templates is kept if None
+    - sender: DicomSender the output files are also sent with
+   
+    Remarks:
+    - one file containing all simulated projection images or one file for each projection image
+    - simulated image dimensions as row x col x n_images or if one image per file row x col
+    - the CT files are taken in slice order (see templateIndex), the simulated files in natural order
+    - returns the list of (file, exception) for the files that could not be modified, including the CT files
+      left without a simulated file
+      
+    """
+    list_files=[entry["name"] for entry in templateIndex(input_folder)]
+    list_sim=listSimImages(sim_input_folder)
+    n_list_sim=len(list_sim)
+    volume=None
+    if n_list_sim == 1:
+        volume=VolumeSource(list_sim[0], mmap)
+    tasks=[]
+    inputs=[]
+    for [index, file] in enumerate(list_files):
+        file_name=os.path.join(input_folder, file)
+        file_name_modified=os.path.join(output_folder, str("modified_"+file))
+        #a template without simulated file fails on its own, see ctReadFile
+        sim_file_name=None if volume or index >= n_list_sim else list_sim[index]
+        tasks.append({"name": file, "output": file_name_modified, "compression": compression, "sender": sender,
+                      "modify": (ctModifyFile, (file_name, file_name_modified, sim_file_name, volume, index, mmap,
+                                                compression, sender)),
+                      "read": (ctReadFile, (file_name, sim_file_name, volume, index, mmap)),
+                      "tags": (ctModifyTags, ())})
+        if incremental:
+            sim_files=simDataFiles(list_sim[0]) if volume else simDataFiles(sim_file_name) if sim_file_name else []
+            inputs.append(([file_name]+sim_files, ["CT", index if volume else None, compression and compression.syntax]))
+    if not incremental:
+        return runFileTasks(tasks, jobs, executor, pipeline=pipeline)
+    manifest=RunManifest(output_folder)
+    try:
+        tasks=skipUpToDate(tasks, inputs, manifest)
+        return runFileTasks(tasks, jobs, executor, manifest, pipeline)
+    finally:
+        manifest.close()
+#%%
+def spectReadFile(file_name, sources, start):
+    """
+    
+    Summary:
+    read a SPECT template and assemble its simulated images
+    
+    Parameters:
+    - see spectModifyFile
+    
+    Remarks:
+    - returns the template header, the simulated images and the value range of the simulated volumes
+      (see PixelConversion)
+    
+    """
+    ds=readTemplate(file_name)
+    array=assembleFrames(ds, sources, start)
+    value_range=lambda: mergeRanges(source.valueRange() for source in sources)
+    return ds, array, value_range
+#%%
+def spectModifyTags(ds, array, model, workstation):
+    """
+    
+    Summary:
+    modify the tags of a SPECT template for a model and workstation
+    
+    Parameters:
+    - ds: the SPECT template header
+    - array: its simulated images
+    - model: name of the SPECTCT model, to be chosen among list_models
+    - workstation: name of the reconstruction workstation, to be chosen among list_stations
+    
+    Remarks:
+    - the tags are modified by the rules of spect_tag_rules for the model and workstation (see compileTagPlan)
+    - returns the simulated images, without the frames of the windows removed by the rules; the frames
+      kept are those of the emission windows tags (see emissionMask)
+    
+    """
+    ### modify tags to prevent original overwriting, and tags of the model and workstation ###
+    with profileStage("tags", ds.filename):
+        renewUIDs(ds)
+        mask=compileTagPlan(model, workstation).apply(ds)["emission_mask"]
+    # frames of the removed (scatter) windows
+    n_frames=int(ds.get("NumberOfFrames", 1) or 1)
+    if array.ndim > 2 and len(array) > n_frames:
+        array=array[mask] if len(array) == len(mask) else array[:n_frames]
+    return array
+#%%
+def spectModifyFile(file_name, output_file_name, sources, start, model, workstation, compression=None, sender=None):
+    """
+    
+    Summary:
+    create one new SPECT DICOM file with new images
+    
+    Parameters:
+    - file_name: path to the original SPECT DICOM file
+    - output_file_name: path to the modified SPECT DICOM file
+    - sources: VolumeSource of the simulated images the frames are taken from, see assembleFrames
+    - start: index of the first frame of the file among all frames of sources
+    - model: name of the SPECTCT model, to be chosen among list_models
+    - workstation: name of the reconstruction workstation, to be chosen among list_stations
+    - compression: Compression of the output file, the transfer syntax of the template is kept if None
+    - sender: DicomSender the output file is also sent with
+    
+    Remarks:
+    - see spectAddSim
+    - spectReadFile, then spectModifyTags, then writeDICOM
+    
+    """
+    ds, array, value_range=spectReadFile(file_name, sources, start)
+    array=spectModifyTags(ds, array, model, workstation)
+    # Save file with the simulated images
+    writeDICOM(ds, array, output_file_name, value_range, compression, sender)
+#%%
+def spectAddSim(input_folder, sim_input_folder, output_folder, model, workstation, mmap=False, jobs=1, executor=None,
+                incremental=False, pipeline=None, compression=None, sender=None):
+    """
+    
+    Summary:
+    create new SPECT DICOM files with new images
+    
+    Parameters:
+    - input_folder: path to the folder containing the original SPECT DICOM files
+    - sim_input_folder: path to the folder containing the simulated images (dcm (or IMA) or hdr or mhd)
+    - output_folder: path to the folder where the modified SPECT DICOM files are to be saved
+    - model: name of the SPECTCT model, to be chosen among list_models
+    - workstation: name of the reconstruction workstation, to be chosen among list_stations
+    - mmap: if True, the simulated images are memory-mapped instead of read into memory
+    - jobs: number of files processed concurrently
+    - executor: thread pool to be used instead of creating one, see runJobs
+    - incremental: if True, the files already up to date in output_folder are not written again, see RunManifest
+    - pipeline: Pipeline overlapping the reads, the tag modifications and the writes of the files, instead of jobs
+    - compression: Compression of the output files, the transfer syntax of the templates is kept if None
+    - sender: DicomSender the output files are also sent with
+    
+    Remarks:
+    - one DICOM file containing all energy windows or one file for each window
+    - the DICOM files are taken in the order of templateIndex (InstanceNumber, then file name), the simulated files in natural order
+    - one file containing all simulated energy windows or one file for each window (or for each window and detector)
+    - simulatde image dimensions as frames x row x col, frames window by window then detector by detector
+    - if there are as many simulated files as DICOM files, each DICOM file takes the frames of one simulated file;
+      otherwise the frames of all simulated files are shared out among the DICOM files in order, see assembleFrames
+    - if workstation = "Hermes", only first energy window is kept (the scatter windows are removed) and related tags are modified
+    - returns the list of (file, exception) for the files that could not be modified
+    
+    """
+    index=templateIndex(input_folder)
+    #just keep first energy window if reconstruction on Hermes
+    if (model == "Optima 640" or model == "Brightview XCT") and workstation == "Hermes":
+        index=index[:1]
+    list_files=[entry["name"] for entry in index]
+    n_files=len(list_files)
+    list_sim=listSimImages(sim_input_folder)
+    n_list_sim=len(list_sim)
+    #one simulated file per DICOM file, or the frames of all simulated files shared out in file order
+    if n_list_sim == n_files:
+        sources=None
+        starts=[0]*n_files
+    else:
+        sources=[VolumeSource(sim_file_name, mmap) for sim_file_name in list_sim]
+        starts=[0]
+        for entry in index[:-1]:
+            #a file that cannot be read counts as one frame, its failure is reported when it is processed
+            starts.append(starts[-1]+entry.get("NumberOfFrames", 1))
+    tasks=[]
+    inputs=[]
+    sim_files=[item for sim_file_name in list_sim for item in simDataFiles(sim_file_name)] if incremental and sources else []
+    for [index, file] in enumerate(list_files):
+        file_name=os.path.join(input_folder, file)
+        file_name_modified=os.path.join(output_folder, str("modified_"+file))
+        file_sources=sources or [VolumeSource(list_sim[index], mmap)]
+        tasks.append({"name": file, "output": file_name_modified, "compression": compression, "sender": sender,
+                      "modify": (spectModifyFile, (file_name, file_name_modified, file_sources, starts[index], model,
+                                                   workstation, compression, sender)),
+                      "read": (spectReadFile, (file_name, file_sources, starts[index])),
+                      "tags": (spectModifyTags, (model, workstation))})
+        if incremental:
+            #one simulated file per DICOM file: only that file is an input
+            file_sim_files=sim_files if sources else simDataFiles(list_sim[index])
+            inputs.append(([file_name]+file_sim_files, ["SPECT", model, workstation, starts[index],
+                                               compression and compression.syntax]))
+    if not incremental:
+        return runFileTasks(tasks, jobs, executor, pipeline=pipeline)
+    manifest=RunManifest(output_folder)
+    try:
+        tasks=skipUpToDate(tasks, inputs, manifest)
+        return runFileTasks(tasks, jobs, executor, manifest, pipeline)
+    finally:
+        manifest.close()
+#%%
+def checkModel(model, workstation):
+    """
+    
+    Summary:
+    check that the model and workstation are recognised
+    
+    Parameters:
+    - model: name of the SPECTCT model
+    - workstation: name of the reconstruction workstation
+   
+    Remarks:
+    - the recognised names are printed if not, and False is returned
+      
+    """
+    if model not in list_models:
+        print("The system model " + str(model) + " is not recognised. \nPlease check the spelling or try another name. \nThe recognised systems are:")
+        for item in list_models:
+            print("\n" + item)
+        return False
+    if workstation not in list_stations:
+        print("The workstation " + str(workstation) + " is not recognised. \nPlease check the spelling or try another name. \nThe recognised workstations are:")
+        for item in list_stations:
+            print("\n" + item)
+        return False
+    return True
+#%%
+def processCase(input_folder, model, workstation, output_folder=None, mmap=False, jobs=1, executor=None,
+                incremental=False, pipeline=None, compression=None, sender=None):
+    """
+    
+    Summary:
+    create the modified CT and SPECT DICOM files of one case
+    
+    Parameters:
+    - input_folder: path to the folder containing the CT, SPECT, sim_CT and sim_SPECT folders
+    - model: name of the SPECTCT model, to be chosen among list_models
+    - workstation: name of the reconstruction workstation, to be chosen among list_stations
+    - output_folder: path to the folder where the modified images are to be saved, input_folder/Output by default
+    - mmap: if True, the simulated images are memory-mapped instead of read into memory
+    - jobs: number of DICOM files processed concurrently
+    - executor: thread pool shared between cases, created for the case if None
+    - incremental: if True, the output files already up to date are not written again
+    - pipeline: Pipeline overlapping the reads, the tag modifications and the writes of the files, instead of jobs
+    - compression: Compression of the output files, the transfer syntax of the templates is kept if None
+    - sender: DicomSender the output files are also sent with
+   
+    Remarks:
+    - returns a summary dict: number of CT and SPECT files in the output folders and failures
+    - the output folders are created if needed; existing files are overwritten, or kept if up to date
+      with incremental
+    - a case may have only a CT or only a SPECT folder
+      
+    """
+    summary={"case": str(input_folder), "model": model, "workstation": workstation, "CT": 0, "SPECT": 0, "failures": []}
+    # Input folders
+    path_CT=Path(input_folder).joinpath("CT")
+    path_SPECT=Path(input_folder).joinpath("SPECT")
+    path_CT_sim=Path(input_folder).joinpath("sim_CT")
+    path_SPECT_sim=Path(input_folder).joinpath("sim_SPECT")
+    # Output folders
+    if output_folder:
+        path_output_folder=Path(output_folder)
+    else:
+        path_output_folder=Path(input_folder).joinpath("Output")
+    path_modified_CT=path_output_folder.joinpath("CT_modified")
+    path_modified_CT.mkdir(parents=True, exist_ok=True)
+    path_modified_SPECT=path_output_folder.joinpath("SPECT_modified")
+    path_modified_SPECT.mkdir(parents=True, exist_ok=True)
+
+    print("\nOriginal acquisition system: " + model + " to be reconstructed on " + workstation
+          + "\nOriginal DICOM files in folders " + str(path_CT) + " and " + str(path_SPECT))
+
+    # Are original and simulated images provided?
+    if not path_CT.is_dir() or os.listdir(path_CT)==[]:
+        print("No CT files provided")
+    elif os.path.isdir(path_CT_sim):
+        if not os.listdir(path_CT_sim)==[]:
+            print("\nImporting simulated CT images from " + str(path_CT_sim))
+            failures=ctAddSim(path_CT, path_CT_sim, path_modified_CT, mmap, jobs, executor, incremental, pipeline,
+                              compression, sender)
+            summary["CT"]=len([file for file in os.listdir(path_modified_CT) if file.startswith("modified_")])
+            summary["failures"].extend(failures)
+            if failures:
+                print("\n" + str(len(failures)) + " CT files could not be modified")
+            else:
+                print("\nCT files successfully modified and saved in " + str(path_modified_CT))
+        else:
+            print("\nNo simulated CT images were found")
+    if not path_SPECT.is_dir() or os.listdir(path_SPECT)==[]:
+        print("No SPECT files provided")
+    elif os.path.isdir(path_SPECT_sim):
+        if not os.listdir(path_SPECT_sim)==[]:
+            print("\nImporting simulated SPECT images from " + str(path_SPECT_sim))
+            failures=spectAddSim(path_SPECT, path_SPECT_sim, path_modified_SPECT, model, workstation, mmap, jobs, executor,
+                               incremental, pipeline, compression, sender)
+            summary["SPECT"]=len([file for file in os.listdir(path_modified_SPECT) if file.startswith("modified_")])
+            summary["failures"].extend(failures)
+            if failures:
+                print("\n" + str(len(failures)) + " SPECT files could not be modified")
+            else:
+                print("\nSPECT files successfully modified and saved in " + str(path_modified_SPECT))
+        else:
+            print("\nNo simulated CT images were found")
+    return summary
+#%%
+def readBatch(batch, model=None, workstation=None):
+    """
+    
+    Summary:
+    list the cases of a batch
+    
+    Parameters:
+    - batch: a manifest (.csv or .json) or a root folder containing one folder per case
+    - model: default SPECTCT model for cases that do not give one
+    - workstation: default reconstruction workstation for cases that do not give one
+   
+    Remarks:
+    - a case is a dict with keys input_folder, model, workstation and optionally output_folder
+    - csv manifest: one row per case with a header line naming these columns, a blank model or workstation
+      cell takes the default
+    - json manifest: a list of such dicts
+    - root folder: every sub-folder containing a CT or SPECT folder is a case; its model and workstation
+      can be given in a case.json file ({"model": ..., "workstation": ...}) inside the case folder
+    - relative input and output folders in a manifest are relative to the manifest folder
+      
+    """
+    batch=Path(batch)
+    if batch.is_dir():
+        cases=[]
+        for folder in natsort.natsorted(os.listdir(batch)):
+            path_case=batch.joinpath(folder)
+            if path_case.joinpath("CT").is_dir() or path_case.joinpath("SPECT").is_dir():
+                case={"input_folder": str(path_case)}
+                if path_case.joinpath("case.json").is_file():
+                    with open(path_case.joinpath("case.json"), "r") as caseFile:
+                        case.update(json.load(caseFile))
+                cases.append(case)
+    elif batch.suffix.lower() == ".json":
+        with open(batch, "r") as batchFile:
+            cases=json.load(batchFile)
+    else:
+        with open(batch, "r", newline="") as batchFile:
+            cases=[dict(row) for row in csv.DictReader(batchFile)]
+    for case in cases:
+        #blank csv cells count as missing
+        if not case.get("model"):
+            case["model"]=model
+        if not case.get("workstation"):
+            case["workstation"]=workstation
+        for key in ["input_folder", "output_folder"]:
+            if case.get(key) and not batch.is_dir():
+                case[key]=str(batch.parent.joinpath(case[key]))
+    return cases
+#%%
+def printBatchSummary(summaries):
+    """
+    
+    Summary:
+    print a summary table of the cases of a batch
+    
+    Parameters:
+    - summaries: list of summary dicts returned by processCase, with "status" and "time" added
+   
+    Remarks:
+    -
+      
+    """
+    header=["Case", "Model", "Workstation", "CT", "SPECT", "Failed", "Time (s)", "Status"]
+    rows=[[Path(item["case"]).name, str(item["model"]), str(item["workstation"]), str(item["CT"]), str(item["SPECT"]),
+           str(len(item["failures"])), "%.1f" % item["time"], item["status"]] for item in summaries]
+    widths=[max(len(row[i]) for row in [header]+rows) for i in range(len(header))]
+    print("\n" + "  ".join(title.ljust(width) for title, width in zip(header, widths)))
+    print("  ".join("-"*width for width in widths))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+#%%
+def processBatch(batch, model=None, workstation=None, mmap=False, jobs=1, incremental=False, executor=None,
+                 pipeline=None, compression=None, sender=None):
+    """
+    
+    Summary:
+    create the modified CT and SPECT DICOM files of every case of a batch in one run
+    
+    Parameters:
+    - batch: a manifest (.csv or .json) or a root folder containing one folder per case, see readBatch
+    - model: default SPECTCT model for cases that do not give one
+    - workstation: default reconstruction workstation for cases that do not give one
+    - mmap: if True, the simulated images are memory-mapped instead of read into memory
+    - jobs: number of DICOM files processed concurrently, the thread pool is shared by all cases
+    - incremental: if True, the output files already up to date are not written again, so an
+      interrupted batch can be run again to finish it
+    - executor: thread pool to be used, created for the batch if None
+    - pipeline: Pipeline overlapping the reads, the tag modifications and the writes of the files, instead of jobs
+    - compression: Compression of the output files, the transfer syntax of the templates is kept if None;
+      cases whose workstation does not accept it are not processed, see checkCompression
+    - sender: DicomSender the output files are also sent with
+   
+    Remarks:
+    - a failing case does not stop the batch; a summary table is printed at the end
+    - returns the list of case summaries
+      
+    """
+    if executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            return processBatch(batch, model, workstation, mmap, jobs, incremental, executor, pipeline,
+                                compression, sender)
+    summaries=[]
+    for case in readBatch(batch, model, workstation):
+        start=time.perf_counter()
+        summary={"case": case["input_folder"], "model": case["model"], "workstation": case["workstation"],
+                 "CT": 0, "SPECT": 0, "failures": []}
+        if not checkModel(case["model"], case["workstation"]):
+            summary["status"]="unknown model or workstation"
+        elif compression is not None and not checkCompression(compression.syntax, case["workstation"]):
+            summary["status"]="output syntax not accepted"
+        else:
+            try:
+                summary=processCase(case["input_folder"], case["model"], case["workstation"], case.get("output_folder"),
+                                    mmap, jobs, executor, incremental, pipeline, compression, sender)
+                summary["status"]="failed files" if summary["failures"] else "ok"
+            except Exception as error:
+                print("Failed to process case " + case["input_folder"] + ": " + repr(error))
+                summary["status"]="error: " + str(error)
+        summary["time"]=time.perf_counter()-start
+        summaries.append(summary)
+    printBatchSummary(summaries)
+    return summaries
+#%%Pre-flight
+def simImageInfo(sim_file_name):
+    """
+    
+    Summary:
+    dimensions and type of a simulated image from its header only, and the problems of its data files
+    
+    Parameters:
+    - sim_file_name: path to the simulated image (dcm (or IMA) or hdr or mhd)
+    
+    Remarks:
+    - returns (dimensions (n_images x row x col), dtype, problems); no pixel data is read
+    - problems: missing data files, or uncompressed data files too short for the dimensions
+    - raises ValueError (or the error of pydicom) if the header cannot be read
+    
+    """
+    sim_file_name=str(sim_file_name)
+    if sim_file_name.lower().endswith(("dcm", "ima")):
+        ds=pydicom.read_file(sim_file_name, stop_before_pixels=True)
+        shape, dtype=pixelShapeDtype(ds)
+        return (1,)*(3-len(shape))+shape, dtype, []
+    if sim_file_name.lower().endswith("hdr"):
+        dimensions, dataFileName, dtype, offset, compressed=readHDR(sim_file_name)
+    else:
+        dimensions, dataFileName, dtype, offset, compressed=readMHD(sim_file_name)
+    dataFileNames=dataFileName if isinstance(dataFileName, list) else [dataFileName]
+    nbytes=int(np.prod(dimensions))*dtype.itemsize//len(dataFileNames)
+    problems=[]
+    for item in dataFileNames:
+        if not os.path.isfile(item):
+            problems.append("data file " + str(item) + " of " + sim_file_name + " is missing")
+        elif not compressed and os.path.getsize(item)-max(offset, 0) < nbytes:
+            problems.append("data file " + str(item) + " has " + str(os.path.getsize(item)-max(offset, 0))
+                            + " bytes of data, " + str(nbytes) + " are needed for " + str(dimensions) + " " + str(dtype))
+    return tuple(dimensions), dtype, problems
+#%%
+def preflightFiles(index, list_sim, needed, output_folder, shared):
+    """
+    
+    Summary:
+    check the pairing of templates with simulated images, from their headers only
+    
+    Parameters:
+    - index: the templates, see templateIndex
+    - list_sim: the simulated images
+    - needed: for each template, the number of images it takes from the simulated images
+    - output_folder: the folder of the output files
+    - shared: if True, the images of all simulated files are taken in order by the templates, otherwise each
+      template takes its images from its own simulated file
+    
+    Remarks:
+    - returns a report dict: files, bytes (expected size of the output files), overwritten (size of the existing
+      output files replaced), problems (the run would fail) and warnings (the run would succeed)
+    - the expected size of an output file is the size of its template header plus its pixel data; windows
+      removed by the tag rules and compression are not counted
+    
+    """
+    report={"files": len(index), "bytes": 0, "overwritten": 0, "problems": [], "warnings": []}
+    infos=[]
+    for sim_file_name in list_sim:
+        try:
+            dimensions, dtype, problems=simImageInfo(sim_file_name)
+            report["problems"].extend(problems)
+            if dtype.kind not in "uifb":
+                report["problems"].append(os.path.basename(sim_file_name) + ": " + str(dtype) + " images cannot be converted")
+            infos.append((sim_file_name, dimensions, dtype))
+        except Exception as error:
+            report["problems"].append(os.path.basename(sim_file_name) + ": " + str(error))
+            infos.append((sim_file_name, None, None))
+    if not shared and len(list_sim) != len(index):
+        report["problems"].append(str(len(index)) + " templates but " + str(len(list_sim)) + " simulated files")
+    n_images=sum(dimensions[0] for sim_file_name, dimensions, dtype in infos if dimensions)
+    if shared and all(dimensions for sim_file_name, dimensions, dtype in infos):
+        if n_images < sum(needed):
+            report["problems"].append(str(len(index)) + " templates need " + str(sum(needed)) + " images, the simulated files have "
+                                      + str(n_images))
+        elif n_images > sum(needed):
+            report["warnings"].append(str(n_images-sum(needed)) + " simulated images are not used (" + str(sum(needed))
+                                      + " needed, " + str(n_images) + " simulated)")
+    for number, entry in enumerate(index):
+        if "error" in entry:
+            report["problems"].append(entry["name"] + ": " + entry["error"])
+            continue
+        template_bytes=entry["Rows"]*entry["Columns"]*entry["NumberOfFrames"]*entry["BitsAllocated"]//8
+        report["bytes"]+=max(entry["size"]-template_bytes, 0)+template_bytes
+        output_file_name=os.path.join(str(output_folder), "modified_"+entry["name"])
+        if os.path.isfile(output_file_name):
+            report["overwritten"]+=os.path.getsize(output_file_name)
+        for sim_file_name, dimensions, dtype in (infos if shared else infos[number:number+1]):
+            if dimensions is None:
+                continue
+            if dimensions[1:] != (entry["Rows"], entry["Columns"]):
+                report["problems"].append(entry["name"] + ": matrix " + str(entry["Rows"]) + " x " + str(entry["Columns"])
+                                          + ", " + os.path.basename(sim_file_name) + ": " + str(dimensions[1]) + " x "
+                                          + str(dimensions[2]))
+            if not shared and dimensions[0] < needed[number]:
+                report["problems"].append(entry["name"] + " needs " + str(needed[number]) + " images, "
+                                          + os.path.basename(sim_file_name) + " has " + str(dimensions[0]))
+            if dtype.kind == "f" or dtype.itemsize*8 > entry["BitsAllocated"]:
+                warning=os.path.basename(sim_file_name) + ": " + str(dtype) + " images rescaled to the " \
+                    + str(entry["BitsAllocated"]) + " bits of the templates if out of range"
+                if warning not in report["warnings"]:
+                    report["warnings"].append(warning)
+    return report
+#%%
+def preflightCase(input_folder, model, workstation, output_folder=None, compression=None):
+    """
+    
+    Summary:
+    check that a case can be processed, from the headers of its templates and simulated images only
+    
+    Parameters:
+    - input_folder: path to the folder containing the CT, SPECT, sim_CT and sim_SPECT folders
+    - model: name of the SPECTCT model, to be chosen among list_models
+    - workstation: name of the reconstruction workstation, to be chosen among list_stations
+    - output_folder: path to the folder where the modified images are to be saved, input_folder/Output by default
+    - compression: output syntax ("rle" or "deflated", see output_syntaxes), the transfer syntax of the templates
+      is kept if None
+    
+    Remarks:
+    - the folders are checked as by processCase: a CT or SPECT folder without simulated images (or the reverse)
+      is not processed (warning), a case with nothing to process and an output syntax not accepted by the
+      workstation (see checkCompression) are problems
+    - the templates are paired with the simulated images as by ctAddSim and spectAddSim: number of slices,
+      frames and files, matrix size and data type, readable headers and complete data files
+    - nothing is written and no pixel data is read
+    - returns a report dict: case, CT and SPECT (reports of preflightFiles), output_folder, bytes (expected size
+      of all output files), overwritten, problems and warnings (all problems of the case, prefixed by CT or SPECT)
+    
+    """
+    path_output_folder=Path(output_folder) if output_folder else Path(input_folder).joinpath("Output")
+    report={"case": str(input_folder), "output_folder": str(path_output_folder), "bytes": 0, "overwritten": 0,
+            "problems": [], "warnings": []}
+    if compression is not None and compression not in workstation_syntaxes.get(workstation, []):
+        report["problems"].append("the output syntax " + str(compression) + " is not accepted by " + str(workstation)
+                                  + " (accepted: " + (", ".join(workstation_syntaxes.get(workstation, [])) or "none") + ")")
+    for modality in ["CT", "SPECT"]:
+        path=Path(input_folder).joinpath(modality)
+        path_sim=Path(input_folder).joinpath("sim_"+modality)
+        templates=path.is_dir() and bool(os.listdir(path))
+        simulated=path_sim.is_dir() and bool(os.listdir(path_sim))
+        if not templates or not simulated:
+            report[modality]=None
+            if templates:
+                report["warnings"].append(modality + " files but no simulated images in " + path_sim.name + ", not processed")
+            elif simulated:
+                report["warnings"].append(modality + " simulated images but no " + modality + " files, not processed")
+            continue
+        index=templateIndex(path)
+        list_sim=listSimImages(path_sim)
+        if modality == "CT":
+            shared=len(list_sim) == 1
+            needed=[1]*len(index)
+        else:
+            if (model == "Optima 640" or model == "Brightview XCT") and workstation == "Hermes":
+                index=index[:1]
+            shared=len(list_sim) != len(index)
+            needed=[entry.get("NumberOfFrames", 1) for entry in index]
+        files=preflightFiles(index, list_sim, needed, path_output_folder.joinpath(modality+"_modified"), shared)
+        report[modality]=files
+        for key in ["bytes", "overwritten"]:
+            report[key]+=files[key]
+        for key in ["problems", "warnings"]:
+            report[key].extend(modality + " " + item for item in files[key])
+    if report["CT"] is None and report["SPECT"] is None:
+        report["problems"].append("no CT or SPECT files with simulated images in " + str(input_folder))
+    return report
+#%%
+def freeSpace(folder):
+    """
+    
+    Summary:
+    free space and device of the file system a folder is (or would be) created on
+    
+    Parameters:
+    - folder: the folder, which may not exist yet
+    
+    Remarks:
+    - returns (free bytes, device id)
+    
+    """
+    import shutil
+    folder=os.path.abspath(str(folder))
+    while not os.path.exists(folder) and os.path.dirname(folder) != folder:
+        folder=os.path.dirname(folder)
+    return shutil.disk_usage(folder).free, os.stat(folder).st_dev
+#%%
+def preflightBatch(batch, model=None, workstation=None, compression=None):
+    """
+    
+    Summary:
+    check every case of a batch (or one case) before processing, and print all the problems at once
+    
+    Parameters:
+    - batch: a manifest or root folder (see readBatch), or a list of cases (dicts as returned by readBatch)
+    - model: default SPECTCT model for cases that do not give one
+    - workstation: default reconstruction workstation for cases that do not give one
+    - compression: output syntax of all cases, see preflightCase
+    
+    Remarks:
+    - see preflightCase; the free space of each file system is checked against the expected size of all the
+      output files written to it (less the files they replace)
+    - returns the list of case reports, with a "status" ("ok" or the number of problems)
+    
+    """
+    cases=batch if isinstance(batch, list) else readBatch(batch, model, workstation)
+    reports=[]
+    needs={}
+    for case in cases:
+        if case.get("model") not in list_models or case.get("workstation") not in list_stations:
+            report={"case": case["input_folder"], "bytes": 0, "overwritten": 0, "warnings": [],
+                    "problems": ["unknown model or workstation: " + str(case.get("model")) + ", " + str(case.get("workstation"))]}
+        else:
+            try:
+                report=preflightCase(case["input_folder"], case["model"], case["workstation"], case.get("output_folder"),
+                                     compression)
+                free, device=freeSpace(report["output_folder"])
+                need=needs.setdefault(device, {"free": free, "bytes": 0, "folders": []})
+                need["bytes"]+=report["bytes"]-report["overwritten"]
+                need["folders"].append(report["output_folder"])
+            except Exception as error:
+                report={"case": case["input_folder"], "bytes": 0, "overwritten": 0, "warnings": [], "problems": [str(error)]}
+        reports.append(report)
+    for need in needs.values():
+        if need["bytes"] > need["free"]:
+            problem="not enough disk space: " + "%.1f" % (need["bytes"]/1e6) + " MB needed, " \
+                + "%.1f" % (need["free"]/1e6) + " MB free"
+            for report in reports:
+                if report.get("output_folder") in need["folders"]:
+                    report["problems"].append(problem)
+    for report in reports:
+        report["status"]="ok" if not report["problems"] else str(len(report["problems"])) + " problems"
+        print("\n" + report["case"] + ": " + report["status"])
+        for key in ["CT", "SPECT"]:
+            if report.get(key):
+                print("  " + key + ": " + str(report[key]["files"]) + " files, " + "%.1f" % (report[key]["bytes"]/1e6) + " MB")
+        for problem in report["problems"]:
+            print("  problem: " + problem)
+        for warning in report["warnings"]:
+            print("  warning: " + warning)
+    n_problems=sum(len(report["problems"]) for report in reports)
+    print("\n" + str(len(reports)) + " cases checked, " + str(n_problems) + " problems, "
+          + "%.1f" % (sum(report["bytes"] for report in reports)/1e6) + " MB to be written")
+    return reports
+#%%DICOM export
+class DicomSender:
+    """
+    
+    Summary:
+    send the output DICOM files to a DICOM node (C-STORE), as they are written
+    
+    Parameters:
+    - destination: "AE_TITLE@HOST:PORT" of the node, e.g. the reconstruction workstation
+    - calling_ae: AE title of DICOM_modify
+    - retries: number of times a file is sent again, on a new association, after a failure
+    - depth: maximum number of files waiting to be sent, the writes wait when it is reached
+    
+    Remarks:
+    - requires pynetdicom; raises ValueError if destination is not AE_TITLE@HOST:PORT
+    - submit(file_name) queues a file written by writeDICOM; one background thread sends the files while the
+      next ones are converted
+    - the files are sent from disk without being decoded, in chunks of the PDU size (pynetdicom
+      _config.STORE_SEND_CHUNKED_DATASET, set for the whole process), so memory does not grow with the file
+      size; only the header is read, to group the files by series. A file is decoded and converted only if the
+      node does not accept its transfer syntax
+    - one association is used for all the files of a series, released when a file of another series
+      comes, or by close()
+    - close() waits for the queued files, prints the number of files sent and the throughput (files/s, MB/s,
+      over the time spent sending), and returns the list of (name, exception) for the files that could not be sent
+    - files kept as up to date with incremental are not sent again
+    - see startStoreSCP for a local stand-in node
+    
+    """
+    def __init__(self, destination, calling_ae="DICOM_MODIFY", retries=2, depth=8):
+        try:
+            import pynetdicom
+        except ImportError:
+            raise ImportError("pynetdicom is required to send the files to a DICOM node: pip install pynetdicom")
+        import queue
+        match = re.match(r"^(.+)@(.+):(\d+)$", str(destination))
+        if match is None:
+            raise ValueError("The DICOM node " + str(destination) + " is not AE_TITLE@HOST:PORT")
+        self.destination = destination
+        self.ae_title, self.host, self.port = match.group(1), match.group(2), int(match.group(3))
+        self.retries = retries
+        self.ae = pynetdicom.AE(ae_title=calling_ae)
+        self.association = None
+        self.series = None
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.failures = []
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        from pynetdicom import _config
+        _config.STORE_SEND_CHUNKED_DATASET = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, file_name):
+        if self.thread is None:
+            raise RuntimeError("The DicomSender to " + self.destination + " is closed")
+        self.queue.put(file_name)
+
+    def _associate(self, ds):
+        from pynetdicom import build_context
+        syntax = ds.file_meta.TransferSyntaxUID
+        syntaxes = [syntax] if syntax.is_compressed or syntax.is_deflated else \
+            [syntax] + [uid for uid in ["1.2.840.10008.1.2.1", "1.2.840.10008.1.2"] if uid != syntax]
+        association = self.ae.associate(self.host, self.port, contexts=[build_context(ds.SOPClassUID, syntaxes)],
+                                        ae_title=self.ae_title)
+        if not association.is_established:
+            raise ConnectionError("Association with " + self.destination + " rejected or aborted")
+        return association
+
+    def _release(self, abort=False):
+        if self.association is not None:
+            if abort:
+                self.association.abort()
+            else:
+                self.association.release()
+        self.association = None
+        self.series = None
+
+    def _send(self, file_name):
+        with profileStage("send", file_name) as record:
+            ds = pydicom.dcmread(file_name, stop_before_pixels=True)
+            syntax = ds.file_meta.TransferSyntaxUID
+            series = (ds.SeriesInstanceUID, ds.SOPClassUID, syntax)
+            if self.series != series or not self.association.is_established:
+                self._release()
+                self.association = self._associate(ds)
+                self.series = series
+            if any(context.transfer_syntax[0] == syntax for context in self.association.accepted_contexts):
+                status = self.association.send_c_store(file_name)
+            else:
+                status = self.association.send_c_store(pydicom.dcmread(file_name))
+            # success, or warnings: coercion of data elements, elements discarded, data set does not match SOP class
+            if "Status" not in status or status.Status not in [0x0000, 0xB000, 0xB006, 0xB007]:
+                raise ConnectionError("C-STORE of " + str(file_name) + " to " + self.destination + " failed"
+                                      + (" with status 0x%04X" % status.Status if "Status" in status else ""))
+            record["bytes_written"] = os.path.getsize(file_name)
+
+    def _run(self):
+        while True:
+            file_name = self.queue.get()
+            if file_name is None:
+                break
+            start = time.perf_counter()
+            for attempt in range(self.retries+1):
+                try:
+                    self._send(file_name)
+                    error = None
+                    break
+                except Exception as error_send:
+                    error = error_send
+                    self._release(abort=True)
+            if error is None:
+                self.files += 1
+                self.bytes += os.path.getsize(file_name)
+            else:
+                self.failures.append((file_name, error))
+            self.seconds += time.perf_counter()-start
+        self._release()
+
+    def close(self):
+        if self.thread is None:
+            return self.failures
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        for name, error in self.failures:
+            print("Failed to send " + str(name) + ": " + repr(error))
+        seconds = self.seconds
+        print("\n" + str(self.files) + " files (" + "%.1f" % (self.bytes/1e6) + " MB) sent to " + self.destination
+              + " in " + "%.1f" % seconds + " s" + (": %.1f files/s, %.1f MB/s" % (self.files/seconds, self.bytes/1e6/seconds)
+                                                    if seconds > 0 else ""))
+        return self.failures
+
+#%%
+def startStoreSCP(port, ae_title="STORESCP", output_folder=None, host="127.0.0.1"):
+    """
+    
+    Summary:
+    start a local stand-in DICOM node receiving files (C-STORE), to test DicomSender
+    
+    Parameters:
+    - port: port the node listens on
+    - ae_title: AE title of the node
+    - output_folder: folder where the received files are saved, not saved if None
+    - host: address the node listens on
+    
+    Remarks:
+    - requires pynetdicom
+    - accepts every storage SOP class in the uncompressed syntaxes and in the syntaxes of output_syntaxes
+    - returns the running server: its received attribute lists the SOPInstanceUID of every file received,
+      server.shutdown() stops it
+    
+    """
+    import pynetdicom
+    received=[]
+    def store(event):
+        ds=event.dataset
+        ds.file_meta=event.file_meta
+        if output_folder is not None:
+            ds.save_as(os.path.join(output_folder, ds.SOPInstanceUID + ".dcm"), write_like_original=False)
+        received.append(ds.SOPInstanceUID)
+        return 0x0000
+    ae=pynetdicom.AE(ae_title=ae_title)
+    syntaxes=["1.2.840.10008.1.2.1", "1.2.840.10008.1.2", "1.2.840.10008.1.2.2"]+list(output_syntaxes.values())
+    for context in pynetdicom.AllStoragePresentationContexts:
+        ae.add_supported_context(context.abstract_syntax, syntaxes)
+    server=ae.start_server((host, port), block=False, evt_handlers=[(pynetdicom.evt.EVT_C_STORE, store)])
+    server.received=received
+    return server
+#%%Library API
+class Converter:
+    """
+    
+    Summary:
+    create modified CT and SPECT DICOM files for one SPECTCT model and reconstruction workstation,
+    to be used from other Python code
+    
+    Parameters:
+    - model: name of the SPECTCT model, to be chosen among list_models
+    - workstation: name of the reconstruction workstation, to be chosen among list_stations
+    - mmap: if True, the simulated images are memory-mapped instead of read into memory
+    - jobs: number of DICOM files processed concurrently
+    - incremental: if True, the output files already up to date are not written again
+    - pipeline: Pipeline overlapping the reads, the tag modifications and the writes of the files, instead of jobs
+    - compression: "rle" or "deflated" to write the files in a lossless compressed transfer syntax
+      (see Compression), None to keep the transfer syntax of the templates
+    - send: "AE_TITLE@HOST:PORT" of a DICOM node the output files are also sent to, or a DicomSender
+    
+    Remarks:
+    - raises ValueError if the model or the workstation is not recognised, or if the workstation does not
+      accept the compression (see workstation_syntaxes)
+    - importing DICOM_modify has no side effect and is fast: numpy, pydicom and natsort are only loaded
+      by the first conversion
+    - made to be reused: the thread pool is kept from one call to the next, as are the module caches
+      (parsed headers); close() it, or use it in a with block, when done
+    - ct() and spect() return the list of (file, exception) for the files that could not be modified,
+      case() the summary dict of processCase, batch() the list of case summaries, preflight() the report
+      of preflightCase (nothing written)
+    - close() waits for the files to be sent; the files that could not be sent are in sender.failures
+    - e.g. with Converter("Symbia T2", "Syngo", jobs=4) as converter: summary=converter.case(input_folder)
+    """
+    def __init__(self, model, workstation, mmap=False, jobs=1, incremental=False, pipeline=None, compression=None,
+                 send=None):
+        if model not in list_models:
+            raise ValueError("The model " + str(model) + " is not recognised, the recognised models are: "
+                             + ", ".join(list_models))
+        if workstation not in list_stations:
+            raise ValueError("The workstation " + str(workstation) + " is not recognised, the recognised workstations are: "
+                             + ", ".join(list_stations))
+        self.model = model
+        self.workstation = workstation
+        self.mmap = mmap
+        self.jobs = jobs
+        self.incremental = incremental
+        if compression is not None and compression not in workstation_syntaxes.get(workstation, []):
+            raise ValueError("The output syntax " + str(compression) + " is not accepted by " + str(workstation)
+                             + ", the accepted syntaxes are: " + ", ".join(workstation_syntaxes.get(workstation, [])))
+        self.pipeline = pipeline
+        self.compression = Compression(compression, jobs) if compression is not None else None
+        self.sender = DicomSender(send) if isinstance(send, str) else send
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None and self.jobs > 1 and self.pipeline is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        return self._executor
+
+    def ct(self, input_folder, sim_input_folder, output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+        return ctAddSim(input_folder, sim_input_folder, output_folder, self.mmap, self.jobs, self.executor,
+                        self.incremental, self.pipeline, self.compression, self.sender)
+
+    def spect(self, input_folder, sim_input_folder, output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+        return spectAddSim(input_folder, sim_input_folder, output_folder, self.model, self.workstation, self.mmap,
+                           self.jobs, self.executor, self.incremental, self.pipeline, self.compression, self.sender)
+
+    def preflight(self, input_folder, output_folder=None):
+        return preflightCase(input_folder, self.model, self.workstation, output_folder,
+                             self.compression and self.compression.syntax)
+
+    def case(self, input_folder, output_folder=None):
+        return processCase(input_folder, self.model, self.workstation, output_folder, self.mmap, self.jobs,
+                           self.executor, self.incremental, self.pipeline, self.compression, self.sender)
+
+    def batch(self, batch):
+        return processBatch(batch, self.model, self.workstation, self.mmap, self.jobs, self.incremental,
+                            self.executor, self.pipeline, self.compression, self.sender)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+        if self.compression is not None:
+            self.compression.close()
+        if self.sender is not None:
+            self.sender.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+#%%Parsing
+def main():
+    # Parse the arguments
+    import argparse
+    parser = argparse.ArgumentParser(description = "Create a copy of original DICOM files with modified images")
+    parser.add_argument("-m", "--model", help="\"Brightview XCT\", \"Discovery 670\", \"Infinia Hawkeye4\", \"Optima 640\", \"Symbia T2\", \"Symbia Intevo Bold\"")
+    parser.add_argument("-w", "--workstation", help="\"Hermes\", \"Jetstream\", \"Syngo\", \"Xeleris\"")
+    parser.add_argument("-i", "--input_folder", help = "Path to the folder containing the original DICOM files and the simulated images \"C:\\Users\\...\"")
+    parser.add_argument("-o", "--output_folder", help = "Optional: Path to the folder where the modified images are to be saved \"C:\\Users\\...\"", required=False)
+    parser.add_argument("-b", "--batch", help = "Instead of -i: manifest (.csv or .json) or root folder of cases to be processed in one run; -m and -w are then defaults for cases that do not give them")
+    parser.add_argument("--mmap", help = "Optional: memory-map the simulated images instead of reading them into memory", action="store_true")
+    parser.add_argument("-j", "--jobs", help = "Optional: number of DICOM files processed concurrently (default 1)", type=int, default=1)
+    parser.add_argument("--incremental", help = "Optional: keep the output files already made from the same (unchanged) inputs and only write the others, e.g. to resume an interrupted run", action="store_true")
+    parser.add_argument("--pipeline", help = "Optional: overlap the reads, the tag modifications (with -j JOBS threads) and the writes of the files, with at most DEPTH files in memory", type=int, metavar="DEPTH")
+    parser.add_argument("--unordered", help = "Optional: with --pipeline, write the files as soon as they are ready instead of in order", action="store_true")
+    parser.add_argument("--compression", help = "Optional: write the files in a lossless compressed transfer syntax accepted by the workstation, RLE Lossless or Deflated Explicit VR Little Endian", choices=list(output_syntaxes))
+    parser.add_argument("--send", help = "Optional: also send the files (C-STORE) to the DICOM node AE_TITLE@HOST:PORT, e.g. the reconstruction workstation (requires pynetdicom)", metavar="AE_TITLE@HOST:PORT")
+    parser.add_argument("--calling-ae", help = "Optional: with --send, AE title of DICOM_modify (default DICOM_MODIFY)", default="DICOM_MODIFY")
+    parser.add_argument("--dry-run", help = "Optional: only check, from the file headers, that every case can be processed (folders, output syntax, numbers of slices, frames and files, matrix sizes, data types, data files and disk space), and report all the problems", action="store_true")
+    parser.add_argument("--profile", help = "Optional: print time, bytes and memory per stage and save a trace of every stage and file (Chrome trace JSON) in PROFILE", metavar="PROFILE")
+    parser._optionals.title = "Arguments"
+    args = parser.parse_args()
+
+    if not args.batch and not (args.input_folder and args.model and args.workstation):
+        parser.error("the following arguments are required: -m/--model, -w/--workstation, -i/--input_folder (or -b/--batch)")
+    if args.dry_run:
+        if args.batch:
+            reports=preflightBatch(args.batch, args.model, args.workstation, args.compression)
+        else:
+            reports=preflightBatch([{"input_folder": args.input_folder, "model": args.model,
+                                     "workstation": args.workstation, "output_folder": args.output_folder}],
+                                   compression=args.compression)
+        print("\n")
+        sys.exit(1 if any(report["problems"] for report in reports) else 0)
+    if args.profile:
+        enableProfiling()
+    pipeline=Pipeline(args.pipeline, workers=args.jobs, ordered=not args.unordered) if args.pipeline else None
+    try:
+        sender=DicomSender(args.send, args.calling_ae) if args.send else None
+    except (ImportError, ValueError) as error:
+        print(error)
+        sys.exit(1)
+
+    if args.batch:
+        compression=Compression(args.compression, args.jobs) if args.compression else None
+        try:
+            summaries=processBatch(args.batch, args.model, args.workstation, args.mmap, args.jobs, args.incremental,
+                                   pipeline=pipeline, compression=compression, sender=sender)
+        finally:
+            if compression is not None:
+                compression.close()
+            if sender is not None:
+                sender.close()
+        failed=any(summary["status"] != "ok" for summary in summaries)
+    else:
+        # Are model and workstation recognised?
+        if not checkModel(args.model, args.workstation):
+            if sender is not None:
+                sender.close()
+            sys.exit()
+        if args.compression and not checkCompression(args.compression, args.workstation):
+            if sender is not None:
+                sender.close()
+            sys.exit(1)
+        # Process the files
+        with Converter(args.model, args.workstation, args.mmap, args.jobs, args.incremental, pipeline,
+                       args.compression, sender) as converter:
+            summary=converter.case(args.input_folder, args.output_folder)
+        failed=bool(summary["failures"])
+    if sender is not None and sender.failures:
+        failed=True
+    if profiler is not None:
+        profiler.printSummary()
+        profiler.saveTrace(args.profile)
+        print("\nProfiling trace saved in " + args.profile)
+    print("\n")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+Summary:
+Benchmark of DICOM_modify.py on synthetic data: template CT and SPECT DICOM files are generated
+for each system of list_models, together with simulated images (hdr, mhd or dcm) of configurable size,
+and each stage of the CT and SPECT pipelines is timed. Results are written as JSON.
+
+Usage: DICOM_modify_benchmark.py [-h] [-m MODEL [MODEL ...]] [-w WORKSTATION]
+                                 [-f FORMAT [FORMAT ...]] [--slices SLICES]
+                                 [--matrix MATRIX] [--frames FRAMES] [--windows WINDOWS]
+                                 [--repeat REPEAT] [-j JOBS] [--mmap]
+                                 [--work_folder WORK_FOLDER] [-o OUTPUT_FILE]
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+#%%Library import
+from pathlib import Path
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+import DICOM_modify
+
+manufacturers={"Brightview XCT": "Philips", "Discovery 670": "GE MEDICAL SYSTEMS", "Infinia Hawkeye4": "GE MEDICAL SYSTEMS",
+               "Optima 640": "GE MEDICAL SYSTEMS", "Symbia T2": "SIEMENS", "Symbia Intevo Bold": "SIEMENS"}
+stages=["discover", "read", "uid", "inject", "write"]
+
+#%%
+def newDataset(sop_class, model, rows, columns):
+    """
+    Summary:
+    create an empty DICOM file of a given SOP class for a given system
+
+    Parameters:
+    - sop_class: the SOP class UID
+    - model: name of the SPECTCT model, among list_models
+    - rows, columns: the image matrix
+
+    Remarks:
+    - explicit VR little endian, 16 bits unsigned images
+    """
+    file_meta=FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID=sop_class
+    file_meta.MediaStorageSOPInstanceUID=generate_uid()
+    file_meta.TransferSyntaxUID=ExplicitVRLittleEndian
+    ds=FileDataset(None, {}, file_meta=file_meta, preamble=b"\x00"*128)
+    ds.is_little_endian=True
+    ds.is_implicit_VR=False
+    ds.SOPClassUID=sop_class
+    ds.SOPInstanceUID=file_meta.MediaStorageSOPInstanceUID
+    ds.Manufacturer=manufacturers[model]
+    ds.ManufacturerModelName=model
+    ds.Rows=rows
+    ds.Columns=columns
+    ds.SamplesPerPixel=1
+    ds.PhotometricInterpretation="MONOCHROME2"
+    ds.BitsAllocated=16
+    ds.BitsStored=16
+    ds.HighBit=15
+    ds.PixelRepresentation=0
+    return ds
+
+#%%
+def makeCTTemplates(folder, model, n_slices, matrix):
+    """
+    Summary:
+    write a synthetic CT series to be used as template
+
+    Parameters:
+    - folder: path to the folder where the CT DICOM files are written
+    - model: name of the SPECTCT model, among list_models
+    - n_slices: number of slices (one file per slice)
+    - matrix: number of rows and columns of each slice
+
+    Remarks:
+    -
+    """
+    study_uid, series_uid=generate_uid(), generate_uid()
+    for index in range(n_slices):
+        ds=newDataset("1.2.840.10008.5.1.4.1.1.2", model, matrix, matrix)
+        ds.Modality="CT"
+        ds.StudyInstanceUID=study_uid
+        ds.SeriesInstanceUID=series_uid
+        ds.InstanceNumber=index+1
+        ds.ImagePositionPatient=[0.0, 0.0, -2.5*index]
+        ds.ImageOrientationPatient=[1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.RescaleIntercept=-1024
+        ds.RescaleSlope=1
+        ds.PixelData=np.zeros((matrix, matrix), np.uint16).tobytes()
+        ds.save_as(os.path.join(folder, "CT%04d.dcm" % (index+1)), write_like_original=False)
+
+#%%
+def makeNMTemplates(folder, model, n_windows, n_frames, matrix):
+    """
+    Summary:
+    write a synthetic SPECT acquisition (one multi-frame NM file per energy window) to be used as template
+
+    Parameters:
+    - folder: path to the folder where the SPECT DICOM files are written
+    - model: name of the SPECTCT model, among list_models
+    - n_windows: number of energy windows (and files)
+    - n_frames: number of projections per energy window
+    - matrix: number of rows and columns of each projection
+
+    Remarks:
+    - the vendor private tags modified by spectAddSim for Hermes are included
+    """
+    study_uid, series_uid=generate_uid(), generate_uid()
+    for window in range(n_windows):
+        ds=newDataset("1.2.840.10008.5.1.4.1.1.20", model, matrix, matrix)
+        ds.Modality="NM"
+        ds.StudyInstanceUID=study_uid
+        ds.SeriesInstanceUID=series_uid
+        ds.SeriesDescription="Tomo EM%d" % (window+1)
+        ds.InstanceNumber=window+1
+        ds.NumberOfFrames=n_frames
+        ds.NumberOfEnergyWindows=1
+        ds.NumberOfDetectors=2
+        ds.NumberOfRotations=1
+        ds.EnergyWindowVector=[1]*n_frames
+        ds.DetectorVector=[1]*(n_frames//2)+[2]*(n_frames-n_frames//2)
+        ds.RotationVector=[1]*n_frames
+        ds.AngularViewVector=list(range(1, n_frames//2+1))+list(range(1, n_frames-n_frames//2+1))
+        energy_range=Dataset()
+        energy_range.EnergyWindowLowerLimit=187.2+10*window
+        energy_range.EnergyWindowUpperLimit=228.8+10*window
+        energy_window=Dataset()
+        energy_window.EnergyWindowRangeSequence=Sequence([energy_range])
+        energy_window.EnergyWindowName="EM%d" % (window+1)
+        ds.EnergyWindowInformationSequence=Sequence([energy_window])
+        if manufacturers[model]=="SIEMENS":
+            ds.add_new(0x00350010, "LO", "SIEMENS MED NM")
+            ds.add_new(0x00351001, "LO", "EM%d" % (window+1))
+            if model=="Symbia Intevo Bold":
+                ds.add_new(0x00610010, "LO", "SIEMENS MED NMSPECT")
+                ds.add_new(0x00611077, "UI", generate_uid())
+                ds.add_new(0x00611078, "UI", generate_uid())
+        elif manufacturers[model]=="GE MEDICAL SYSTEMS":
+            ds.add_new(0x00110010, "LO", "GEMS_GENIE_1")
+            ds.add_new(0x0011100D, "LO", "Scatter windows")
+            for tag in [0x00111012, 0x00111030, 0x00111050]:
+                ds.add_new(tag, "LO", "EM%d" % (window+1))
+            ds.add_new(0x00550010, "LO", "GEMS_GENIE_1")
+            item=Dataset()
+            item.add_new(0x00550010, "LO", "GEMS_GENIE_1")
+            item.add_new(0x00551013, "SL", window+1)
+            ds.add_new(0x00551012, "SQ", Sequence([item]))
+        ds.PixelData=np.zeros((n_frames, matrix, matrix), np.uint16).tobytes()
+        ds.save_as(os.path.join(folder, "NM_EM%d.dcm" % (window+1)), write_like_original=False)
+
+#%%
+def writeSimImage(file_name, array):
+    """
+    Summary:
+    write a simulated volume as interfile (.hdr), MetaImage (.mhd) or DICOM (.dcm)
+
+    Parameters:
+    - file_name: the name of the header (or DICOM) file, its extension gives the format
+    - array: the images (n_images x row x col), 16 bits unsigned
+
+    Remarks:
+    - raw data next to the header, with the same name and extension .raw
+    """
+    array=np.ascontiguousarray(array, dtype="<u2")
+    n_images, rows, columns=array.shape
+    if file_name.lower().endswith("dcm"):
+        ds=newDataset("1.2.840.10008.5.1.4.1.1.7.3", "Symbia T2", rows, columns)
+        ds.NumberOfFrames=n_images
+        ds.PixelData=array.tobytes()
+        ds.save_as(file_name, write_like_original=False)
+        return
+    raw_name=os.path.splitext(file_name)[0]+".raw"
+    array.tofile(raw_name)
+    if file_name.lower().endswith("hdr"):
+        header=["!INTERFILE:=", "!name of data file:="+os.path.basename(raw_name),
+                "!matrix size [1]:="+str(columns), "!matrix size [2]:="+str(rows),
+                "!number of projections:="+str(n_images), "imagedata byte order:=LITTLEENDIAN",
+                "!number format:=unsigned integer", "!number of bytes per pixel:=2"]
+    else:
+        header=["ObjectType = Image", "NDims = 3", "DimSize = %d %d %d" % (columns, rows, n_images),
+                "ElementType = MET_USHORT", "ElementByteOrderMSB = False",
+                "ElementDataFile = "+os.path.basename(raw_name)]
+    with open(file_name, "w") as headerFile:
+        headerFile.write("\n".join(header)+"\n")
+
+#%%
+def makeCase(folder, model, sim_format, n_slices, matrix, n_frames, n_windows):
+    """
+    Summary:
+    write a complete synthetic case (CT, SPECT, sim_CT and sim_SPECT folders) for one system
+
+    Parameters:
+    - folder: path to the case folder
+    - model: name of the SPECTCT model, among list_models
+    - sim_format: format of the simulated images, "hdr", "mhd" or "dcm"
+    - n_slices, matrix: number of CT slices and CT matrix
+    - n_frames, n_windows: number of projections per energy window and number of energy windows
+
+    Remarks:
+    - one simulated CT volume; one simulated SPECT file per energy window, 64 x 64 projections
+    """
+    for name in ["CT", "SPECT", "sim_CT", "sim_SPECT"]:
+        Path(folder).joinpath(name).mkdir(parents=True)
+    makeCTTemplates(os.path.join(folder, "CT"), model, n_slices, matrix)
+    makeNMTemplates(os.path.join(folder, "SPECT"), model, n_windows, n_frames, 64)
+    rng=np.random.default_rng(0)
+    writeSimImage(os.path.join(folder, "sim_CT", "ct."+sim_format), rng.integers(0, 2000, (n_slices, matrix, matrix)))
+    for window in range(n_windows):
+        writeSimImage(os.path.join(folder, "sim_SPECT", "proj_EM%d.%s" % (window+1, sim_format)),
+                      rng.poisson(5+window, (n_frames, 64, 64)))
+
+#%%
+class StageTimer:
+    """
+    Summary:
+    accumulate time, number of files and bytes of each stage
+
+    Parameters:
+    -
+
+    Remarks:
+    - use "with timer.stage(name, n_bytes):" around the code of a stage
+    """
+    def __init__(self):
+        self.totals={name: {"seconds": 0.0, "files": 0, "bytes": 0} for name in stages}
+
+    @contextmanager
+    def stage(self, name, n_bytes=0):
+        start=time.perf_counter()
+        yield
+        total=self.totals[name]
+        total["seconds"]+=time.perf_counter()-start
+        total["files"]+=1
+        total["bytes"]+=n_bytes
+
+    def report(self):
+        return {name: rates(**total) for name, total in self.totals.items()}
+
+#%%
+def rates(seconds, files, bytes):
+    """
+    Summary:
+    throughput in files/s and MB/s
+    """
+    return {"seconds": seconds, "files": files, "bytes": bytes,
+            "files_per_s": files/seconds if seconds else None,
+            "MB_per_s": bytes/1e6/seconds if seconds else None}
+
+#%%
+def timeStages(input_folder, sim_input_folder, output_folder, mmap=False):
+    """
+    Summary:
+    run the stages of the per-file pipeline one after the other on every template file and time each of them
+
+    Parameters:
+    - input_folder: path to the folder containing the template DICOM files
+    - sim_input_folder: path to the folder containing the simulated images
+    - output_folder: path to the folder where the modified DICOM files are written
+    - mmap: if True, the simulated images are memory-mapped
+
+    Remarks:
+    - one simulated file for all templates (sliced) or one per template, as in ctAddSim/spectAddSim
+    - discover: template index (see DICOM_modify.templateIndex) and sorting of the simulated files; read: template header and simulated images;
+      uid: UID rewrite; inject: conversion of the images to the output pixel type (PixelConversion); write: writeDICOM
+    """
+    timer=StageTimer()
+    with timer.stage("discover"):
+        list_files=[entry["name"] for entry in DICOM_modify.templateIndex(input_folder)]
+        list_sim=DICOM_modify.listSimImages(sim_input_folder)
+    volume=DICOM_modify.VolumeSource(list_sim[0], mmap) if len(list_sim)==1 else None
+    for index, file in enumerate(list_files):
+        file_name=os.path.join(input_folder, file)
+        with timer.stage("read", os.path.getsize(file_name)):
+            ds=DICOM_modify.readTemplate(file_name)
+            array=volume.slice(index) if volume is not None else DICOM_modify.image_to_array(list_sim[index], mmap)
+        with timer.stage("uid"):
+            DICOM_modify.renewUIDs(ds)
+        with timer.stage("inject", array.nbytes):
+            value_range=volume.valueRange if volume is not None else None
+            array=DICOM_modify.PixelConversion(ds, array, value_range)(array)
+        output_file_name=os.path.join(output_folder, "modified_"+file)
+        with timer.stage("write"):
+            DICOM_modify.writeDICOM(ds, array, output_file_name)
+        timer.totals["write"]["bytes"]+=os.path.getsize(output_file_name)
+    return timer.report()
+
+#%%
+def timePipeline(function, arguments):
+    """
+    Summary:
+    time a complete ctAddSim or spectAddSim run
+
+    Parameters:
+    - function: DICOM_modify.ctAddSim or DICOM_modify.spectAddSim
+    - arguments: the arguments of function, the output folder (third one) is emptied first
+
+    Remarks:
+    -
+    """
+    output_folder=arguments[2]
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    start=time.perf_counter()
+    failures=function(*arguments)
+    seconds=time.perf_counter()-start
+    files=os.listdir(output_folder)
+    n_bytes=sum(os.path.getsize(os.path.join(output_folder, file)) for file in files)
+    result=rates(seconds, len(files), n_bytes)
+    result["failures"]=len(failures)
+    return result
+
+#%%
+def timeParsers(case_folder, sim_format, repeat=200):
+    """
+    Summary:
+    time the header parsers (readHDR or readMHD) on the simulated SPECT headers of a case
+
+    Parameters:
+    - case_folder: path to the case folder
+    - sim_format: format of the simulated images, "hdr" or "mhd" ("dcm" returns None)
+    - repeat: number of times each header is read
+
+    Remarks:
+    - "cold": the header cache is cleared before each read; "cached": repeated reads of unchanged headers
+    """
+    if sim_format=="dcm":
+        return None
+    parser=DICOM_modify.readHDR if sim_format=="hdr" else DICOM_modify.readMHD
+    headers=DICOM_modify.listSimImages(os.path.join(case_folder, "sim_SPECT"))
+    n_headers=repeat*len(headers)
+    result={"parser": parser.__name__, "headers": n_headers}
+    for mode in ["cold", "cached"]:
+        start=time.perf_counter()
+        for _ in range(repeat):
+            for header in headers:
+                if mode=="cold":
+                    DICOM_modify._parseHeader.cache_clear()
+                parser(header)
+        seconds=time.perf_counter()-start
+        result[mode]={"seconds": seconds, "headers_per_s": n_headers/seconds}
+    return result
+
+#%%
+def runBenchmark(models, workstation, formats, n_slices, matrix, n_frames, n_windows, repeat=1, jobs=1, mmap=False,
+                 work_folder=None):
+    """
+    Summary:
+    generate the synthetic cases and time the CT and SPECT pipelines for each model and simulated image format
+
+    Parameters:
+    - models: names of the SPECTCT models, among list_models
+    - workstation: name of the reconstruction workstation used for spectAddSim
+    - formats: formats of the simulated images, among "hdr", "mhd" and "dcm"
+    - n_slices, matrix: number of CT slices and CT matrix
+    - n_frames, n_windows: number of projections per energy window and number of energy windows
+    - repeat: number of timed runs per case, the fastest one is kept
+    - jobs: number of files processed concurrently in the complete runs
+    - mmap: if True, the simulated images are memory-mapped
+    - work_folder: folder for the synthetic cases, a temporary folder (removed afterwards) if None
+
+    Remarks:
+    - returns a dict ready to be written as JSON
+    """
+    config={"models": models, "workstation": workstation, "formats": formats, "slices": n_slices, "matrix": matrix,
+            "frames": n_frames, "windows": n_windows, "repeat": repeat, "jobs": jobs, "mmap": mmap}
+    environment={"python": platform.python_version(), "numpy": np.__version__, "pydicom": pydicom.__version__,
+                 "platform": platform.platform()}
+    results=[]
+    temporary=work_folder is None
+    work_folder=tempfile.mkdtemp(prefix="DICOM_modify_benchmark_") if temporary else work_folder
+    try:
+        for model in models:
+            for sim_format in formats:
+                case_folder=os.path.join(work_folder, model.replace(" ", "_")+"_"+sim_format)
+                shutil.rmtree(case_folder, ignore_errors=True)
+                makeCase(case_folder, model, sim_format, n_slices, matrix, n_frames, n_windows)
+                path=lambda name: os.path.join(case_folder, name)
+                for modality in ["CT", "SPECT"]:
+                    output_folder=path("Output_"+modality)
+                    runs=[]
+                    for _ in range(repeat):
+                        shutil.rmtree(output_folder, ignore_errors=True)
+                        os.makedirs(output_folder)
+                        runs.append({"stages": timeStages(path(modality), path("sim_"+modality), output_folder, mmap)})
+                        if modality=="CT":
+                            runs[-1]["pipeline"]=timePipeline(DICOM_modify.ctAddSim,
+                                                              [path("CT"), path("sim_CT"), output_folder, mmap, jobs])
+                        else:
+                            runs[-1]["pipeline"]=timePipeline(DICOM_modify.spectAddSim,
+                                                              [path("SPECT"), path("sim_SPECT"), output_folder, model,
+                                                               workstation, mmap, jobs])
+                    best=min(runs, key=lambda run: run["pipeline"]["seconds"])
+                    results.append({"model": model, "modality": modality, "sim_format": sim_format, **best})
+                parsers=timeParsers(case_folder, sim_format)
+                if parsers:
+                    results.append({"model": model, "modality": "header", "sim_format": sim_format, "parsers": parsers})
+    finally:
+        if temporary:
+            shutil.rmtree(work_folder, ignore_errors=True)
+    return {"config": config, "environment": environment, "results": results}
+
+#%%
+def printResults(report):
+    """
+    Summary:
+    print a short human-readable version of the benchmark results
+    """
+    for result in report["results"]:
+        name=result["model"]+" "+result["modality"]+" ("+result["sim_format"]+")"
+        if "pipeline" in result:
+            pipeline=result["pipeline"]
+            print("%-40s %8.1f files/s %8.1f MB/s" % (name, pipeline["files_per_s"] or 0, pipeline["MB_per_s"] or 0))
+        else:
+            parsers=result["parsers"]
+            print("%-40s %8.0f headers/s (cold) %8.0f headers/s (cached)" % (name, parsers["cold"]["headers_per_s"],
+                                                                          parsers["cached"]["headers_per_s"]))
+
+#%%Parsing
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark DICOM_modify.py on synthetic data")
+    parser.add_argument("-m", "--model", help="Systems to benchmark (default: all of list_models)", nargs="+",
+                        default=DICOM_modify.list_models)
+    parser.add_argument("-w", "--workstation", help="Workstation used for the SPECT files (default Hermes)", default="Hermes")
+    parser.add_argument("-f", "--format", help="Formats of the simulated images: hdr, mhd, dcm (default all)", nargs="+",
+                        default=["hdr", "mhd", "dcm"])
+    parser.add_argument("--slices", help="Number of CT slices (default 64)", type=int, default=64)
+    parser.add_argument("--matrix", help="CT matrix (default 256)", type=int, default=256)
+    parser.add_argument("--frames", help="Number of SPECT projections per energy window (default 60)", type=int, default=60)
+    parser.add_argument("--windows", help="Number of SPECT energy windows (default 3)", type=int, default=3)
+    parser.add_argument("--repeat", help="Number of timed runs per case, the fastest is kept (default 1)", type=int, default=1)
+    parser.add_argument("-j", "--jobs", help="Number of DICOM files processed concurrently (default 1)", type=int, default=1)
+    parser.add_argument("--mmap", help="Memory-map the simulated images", action="store_true")
+    parser.add_argument("--work_folder", help="Folder for the synthetic cases (default: temporary folder)")
+    parser.add_argument("-o", "--output_file", help="JSON file for the results (default: printed)")
+    parser._optionals.title = "Arguments"
+    args = parser.parse_args()
+
+    for model in args.model:
+        if not DICOM_modify.checkModel(model, args.workstation):
+            sys.exit()
+    report=runBenchmark(args.model, args.workstation, args.format, args.slices, args.matrix, args.frames, args.windows,
+                        args.repeat, args.jobs, args.mmap, args.work_folder)
+    printResults(report)
+    if args.output_file:
+        with open(args.output_file, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()